@@ -2,21 +2,27 @@
 DropOne — Dynamic Product Catalog v4.0
 Auto-syncs from CJ Dropshipping API.
 - Supabase persistent cache (survives Vercel cold starts)
-- Concurrent API calls (fits in 10s Vercel timeout)
+- Concurrent API calls (fits in 10s Vercel timeout; runs on uvloop when installed, see index.py)
 - Weekly cron sync with query rotation (Set A / Set B every 2 weeks)
 - Dead product cleanup (removes 404 / out-of-stock)
 - Callable via external cron (cron-job.org)
 """
 
 import os
-import json
 import time
 import asyncio
+import sys
 import logging
+import heapq
 import hashlib
+from collections import defaultdict
 from datetime import datetime
 from typing import Optional
 
+import httpx
+
+import jsonio
+
 logger = logging.getLogger("dropone.catalog")
 
 # ---------------------------------------------------------------------------
@@ -27,7 +33,12 @@ MARGIN_MULTIPLIER = 2.5      # 60% margin
 MIN_MARGIN_MULTIPLIER = 2.0
 MAX_PRICE = 99.99
 PRODUCTS_PER_QUERY = 10
-CONCURRENT_BATCH = 24        # All queries at once (16 max with 2 per cat)
+CONCURRENT_BATCH = 24        # Max concurrent CJ queries (adaptive limiter ceiling)
+INITIAL_CONCURRENCY = 8      # Starting point, adapted to CJ's failure rate
+MAX_CACHED_PRODUCTS = 1000   # Hard cap on the in-memory catalog (keeps top trending)
+CLEANUP_CONCURRENCY = 8      # Parallel CJ product checks during cleanup
+CLEANUP_TIMEOUT = 15.0       # Whole cleanup pass, not per batch
+SAVE_DRAIN_TIMEOUT = 10.0    # Shutdown wait for in-flight snapshot saves
 
 # ---------------------------------------------------------------------------
 # QUERY ROTATION — Set A / Set B alternate every 2 weeks
@@ -83,13 +94,102 @@ CATEGORY_TAGS = {
     "auto": ["car", "auto"],
 }
 
+# Shared string objects: every product dict points at these instead of its own copy
+_SUPPLIER = sys.intern("cj_dropshipping")
+_SHIPPING = sys.intern("7-14 days")
+_CAT_INTERNED = {c: sys.intern(c) for c in (*CATEGORY_QUERIES_A, *CATEGORY_QUERIES_B)}
+
+# Name keywords promoted to tags (already lowercased)
+_KW_LOWER = ("led", "wireless", "bluetooth", "smart", "mini", "portable")
+
 # In-memory cache (fast reads within same request/container)
 _cache = {
     "products": [],
     "last_sync": 0,
-    "syncing": False,
 }
 
+# Current catalog, rebound by _reindex; hot paths read this instead of _cache["products"]
+PRODUCTS: list = []
+
+# O(1) lookups over PRODUCTS, rebuilt by _reindex
+_by_id: dict[str, dict] = {}
+_by_cj_pid: dict[str, dict] = {}
+
+# Read-only views served straight to the storefront, also rebuilt by _reindex
+_by_category: dict[str, list] = {}
+_categories_sorted: list[str] = []
+_trending_sorted: list = []
+
+# Search text per product, aligned with PRODUCTS. Kept out of the product dicts,
+# which are served as-is and persisted (stores.product_data, kv_cache).
+_search_blobs: list[str] = []
+
+# get_catalog_stats fields that only change when the catalog does, rebuilt by _reindex
+_stats_base: dict = {"total_products": 0, "categories": 0, "avg_margin": 0}
+
+# Fire-and-forget tasks, referenced here so they aren't garbage-collected mid-flight
+_background_tasks: set = set()
+
+
+def _run_in_background(coro) -> asyncio.Task:
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+
+def _pending_background() -> list:
+    """Background tasks of the running loop (a task can't be awaited from another loop)."""
+    loop = asyncio.get_running_loop()
+    return [t for t in _background_tasks if t.get_loop() is loop]
+
+
+def _set_catalog(products: list, synced_at: Optional[float] = None):
+    """Install a new in-memory catalog: enforce the size cap, then rebuild indexes."""
+    if len(products) > MAX_CACHED_PRODUCTS:
+        keep = {id(p) for p in heapq.nlargest(MAX_CACHED_PRODUCTS, products, key=lambda p: p["trending_score"])}
+        logger.warning(f"Catalog capped at {MAX_CACHED_PRODUCTS} of {len(products)} products")
+        products = [p for p in products if id(p) in keep]
+    _cache["products"] = products
+    if synced_at is not None:
+        _cache["last_sync"] = synced_at
+    _reindex(products)
+
+
+def _cache_fresh(now: float) -> bool:
+    return bool(_cache["products"]) and (now - _cache["last_sync"]) < CACHE_TTL
+
+
+def _reindex(products: list):
+    """Rebuild lookup indexes. Called by _set_catalog; don't assign _cache["products"] directly."""
+    global PRODUCTS, _by_id, _by_cj_pid, _by_category, _categories_sorted, _trending_sorted
+    global _stats_base, _search_blobs
+    PRODUCTS = products
+    # Sort once; the sort is stable, so each category list built below
+    # comes out trending-ordered too. Everything else is one pass.
+    trending = sorted(products, key=lambda p: -p["trending_score"])
+    id_index, pid_index = {}, {}
+    by_category = defaultdict(list)
+    margin_total = 0
+    for p in trending:
+        id_index[p["id"]] = p
+        if p.get("cj_pid"):
+            pid_index[p["cj_pid"]] = p
+        by_category[p["category"]].append(p)
+        margin_total += p["margin_pct"]
+    _by_id = id_index
+    _by_cj_pid = pid_index
+    _by_category = by_category
+    _categories_sorted = sorted(by_category)
+    _trending_sorted = trending
+    _stats_base = {
+        "total_products": len(products),
+        "categories": len(by_category),
+        "avg_margin": round(margin_total / len(products), 1) if products else 0,
+    }
+
+    _search_blobs = [_search_blob(p) for p in products]
+
 
 # ---------------------------------------------------------------------------
 # SUPABASE PERSISTENT CACHE
@@ -108,48 +208,131 @@ def _supabase_url():
     return os.getenv("SUPABASE_URL", "").rstrip("/")
 
 
-def _save_to_supabase(products: list):
-    """Persist catalog to Supabase for cold start recovery."""
-    import httpx
+# Shared client: keeps the TLS connection to Supabase alive across calls.
+# Its pool belongs to the loop that created it, so it is rebuilt when the loop changes
+# (serverless runtimes may run each invocation on a new loop).
+_http: Optional[httpx.AsyncClient] = None
+_http_loop: Optional[asyncio.AbstractEventLoop] = None
+
+
+def _get_http() -> httpx.AsyncClient:
+    global _http, _http_loop
+    loop = asyncio.get_running_loop()
+    if _http is None or _http_loop is not loop:
+        _http_loop = loop
+        _http = httpx.AsyncClient(
+            http2=True,
+            timeout=5.0,
+            limits=httpx.Limits(max_keepalive_connections=4),
+        )
+    return _http
+
+
+async def aclose():
+    """Close the shared Supabase client (app shutdown), after pending saves finish."""
+    global _http, _http_loop
+    tasks = _pending_background()
+    if tasks:
+        _, pending = await asyncio.wait(tasks, timeout=SAVE_DRAIN_TIMEOUT)
+        if pending:
+            logger.warning(f"Shutdown: {len(pending)} catalog save(s) still running, closing anyway")
+    # A client from another loop can't be closed from this one: just drop it
+    if _http is not None and _http_loop is asyncio.get_running_loop():
+        await _http.aclose()
+    _http = _http_loop = None
+
+
+def _parse_ts(value) -> float:
+    """Epoch seconds from a PostgREST timestamptz string (0 if missing/unparseable)."""
+    try:
+        return datetime.fromisoformat(value).timestamp()
+    except (TypeError, ValueError):
+        return 0
+
+
+async def _save_to_supabase(products: list):
+    """Persist catalog to Supabase for cold start recovery.
+
+    Skips the upload when the stored catalog is identical (content_hash) and
+    only bumps updated_at, which _load_from_supabase treats as the sync time.
+    """
     url = _supabase_url()
     if not url:
         return
     try:
-        blob = json.dumps({
-            "products": products,
-            "synced_at": time.time(),
-            "query_set": _get_active_set_name(),
-            "product_count": len(products),
-        })
-        httpx.post(
+        http = _get_http()
+        headers = _supabase_headers()
+        now = time.time()
+        updated_at = datetime.utcfromtimestamp(now).isoformat() + "+00:00"
+        content_hash = hashlib.blake2s(jsonio.dumps(products)).hexdigest()
+
+        # 400 here means content_hash doesn't exist yet (migration-perf.sql not run)
+        resp = await http.get(
             f"{url}/rest/v1/kv_cache",
-            headers={**_supabase_headers(), "Prefer": "resolution=merge-duplicates"},
-            json={"id": "cj_catalog", "value": blob},
-            timeout=5,
+            headers=headers,
+            params={"id": "eq.cj_catalog", "select": "content_hash"},
+        )
+        has_hash = resp.status_code == 200
+        rows = jsonio.loads(resp.content) if has_hash else []
+        if rows and rows[0].get("content_hash") == content_hash:
+            await http.patch(
+                f"{url}/rest/v1/kv_cache",
+                headers=headers,
+                params={"id": "eq.cj_catalog"},
+                content=jsonio.dumps({"updated_at": updated_at}),
+            )
+            logger.info(f"Supabase cache unchanged ({len(products)} products), marked fresh")
+            return
+
+        # value is jsonb (migration-perf.sql): send the object itself, not a JSON string inside JSON
+        row = {
+            "id": "cj_catalog",
+            "value": {
+                "products": products,
+                "synced_at": now,
+                "query_set": _get_active_set_name(),
+                "product_count": len(products),
+            },
+            "updated_at": updated_at,
+        }
+        if has_hash:
+            row["content_hash"] = content_hash
+        await http.post(
+            f"{url}/rest/v1/kv_cache",
+            headers={**headers, "Prefer": "resolution=merge-duplicates"},
+            content=jsonio.dumps(row),
         )
         logger.info(f"Saved {len(products)} products to Supabase cache (set {_get_active_set_name()})")
     except Exception as e:
         logger.warning(f"Supabase cache save failed: {e}")
 
 
-def _load_from_supabase() -> tuple:
+async def _load_from_supabase() -> tuple:
     """Load catalog from Supabase. Returns (products, synced_at)."""
-    import httpx
     url = _supabase_url()
     if not url:
         return [], 0
     try:
-        resp = httpx.get(
+        # Single-object response: no list wrapper; 406 when the row doesn't exist
+        resp = await _get_http().get(
             f"{url}/rest/v1/kv_cache",
-            headers=_supabase_headers(),
-            params={"id": "eq.cj_catalog", "select": "value"},
-            timeout=5,
+            headers={**_supabase_headers(), "Accept": "application/vnd.pgrst.object+json"},
+            params={"id": "eq.cj_catalog", "select": "value,updated_at"},
         )
-        rows = resp.json()
-        if rows and rows[0].get("value"):
-            data = json.loads(rows[0]["value"])
+        row = jsonio.loads(resp.content) if resp.status_code == 200 else None
+        if row and row.get("value"):
+            data = row["value"]
+            if isinstance(data, str):  # TEXT column, before migration-perf.sql
+                data = jsonio.loads(data)
             products = data.get("products", [])
-            synced_at = data.get("synced_at", 0)
+            # An unchanged re-sync only bumps updated_at (see _save_to_supabase)
+            synced_at = max(data.get("synced_at", 0), _parse_ts(row.get("updated_at")))
+            for p in products:
+                # Decoded JSON gives each dict fresh copies of the repeated labels
+                for k in ("category", "supplier", "shipping_time"):
+                    if isinstance(p.get(k), str):
+                        p[k] = sys.intern(p[k])
+                p.pop("_search_blob", None)  # snapshots saved while it lived on the product
             logger.info(f"Loaded {len(products)} from Supabase (age: {(time.time()-synced_at)/3600:.1f}h)")
             return products, synced_at
     except Exception as e:
@@ -157,19 +340,16 @@ def _load_from_supabase() -> tuple:
     return [], 0
 
 
-def _save_sync_log(stats: dict):
+async def _save_sync_log(stats: dict):
     """Save sync history for monitoring."""
-    import httpx
     url = _supabase_url()
     if not url:
         return
     try:
-        blob = json.dumps(stats)
-        httpx.post(
+        await _get_http().post(
             f"{url}/rest/v1/kv_cache",
             headers={**_supabase_headers(), "Prefer": "resolution=merge-duplicates"},
-            json={"id": f"sync_log_{int(time.time())}", "value": blob},
-            timeout=5,
+            content=jsonio.dumps({"id": f"sync_log_{int(time.time())}", "value": stats}),
         )
     except Exception:
         pass
@@ -181,80 +361,120 @@ def _save_sync_log(stats: dict):
 def _parse_price(price_str) -> float:
     if not price_str:
         return 0.0
-    s = str(price_str).strip()
-    if "--" in s:
-        parts = s.split("--")
-        try:
-            return float(parts[0].strip())
-        except (ValueError, IndexError):
-            return 0.0
+    if isinstance(price_str, (int, float)) and not isinstance(price_str, bool):
+        return float(price_str)
+    # CJ ranges look like "3.5--4.2": take the low end; anything unparseable is 0.0
+    s = str(price_str).partition("--")[0].strip()
     try:
         return float(s)
     except ValueError:
         return 0.0
 
 
-def _transform(cj_product: dict, category: str, query: str, index: int) -> Optional[dict]:
-    """Transform CJ API product to DropOne format."""
-    pid = cj_product.get("pid", "")
-    name = cj_product.get("productNameEn", "")
-    image = cj_product.get("productImage", "")
-    cost = _parse_price(cj_product.get("sellPrice", 0))
-
-    if cost <= 0 or not name:
-        return None
+def _coerce_weight_g(w) -> int:
+    """CJ weight (number or numeric string) in grams; values under 50 are taken as kg."""
+    if not w:
+        return 0
+    try:
+        f = float(w)
+    except (TypeError, ValueError):
+        return 0
+    return int(f * 1000) if f < 50 else int(f)
 
-    suggested = min(round(cost * MARGIN_MULTIPLIER, 2), MAX_PRICE)
-    if suggested < cost * MIN_MARGIN_MULTIPLIER:
-        suggested = round(cost * MIN_MARGIN_MULTIPLIER, 2)
-    margin_pct = round((1 - cost / suggested) * 100) if suggested > 0 else 0
 
-    stable_id = f"cj-{hashlib.md5(pid.encode()).hexdigest()[:8]}"
+# pid -> product id; the same pids come back sync after sync
+_stable_id_cache: dict[str, str] = {}
 
-    images = [image] if image else []
-    for img in cj_product.get("productImageSet", [])[:3]:
-        u = img.get("imageUrl", "") if isinstance(img, dict) else str(img)
-        if u and u not in images:
-            images.append(u)
 
-    if len(name) > 60:
-        name = name[:57] + "..."
+def _stable_id(pid: str) -> str:
+    """DropOne product id for a CJ pid. Must stay MD5-derived: ids are stored on orders and in store URLs."""
+    sid = _stable_id_cache.get(pid)
+    if sid is None:
+        # First 4 digest bytes == first 8 hex chars: same ids as before, no 32-char hex string.
+        sid = f"cj-{hashlib.md5(pid.encode(), usedforsecurity=False).digest()[:4].hex()}"
+        _stable_id_cache[pid] = sid
+    return sid
 
-    tags = list(CATEGORY_TAGS.get(category, ["trending"]))
-    for kw in ["LED", "wireless", "bluetooth", "smart", "mini", "portable"]:
-        if kw.lower() in name.lower():
-            tags.append(kw.lower())
-    tags = list(set(tags))[:5]
 
-    weight = cj_product.get("productWeight", 0)
-    if isinstance(weight, str):
-        try:
-            weight = float(weight)
-        except ValueError:
-            weight = 0
+def _make_transformer(category: str):
+    """Build the CJ -> DropOne transform for one category.
 
-    return {
-        "id": stable_id,
-        "cj_pid": pid,
-        "cj_vid": "",
-        "name": name,
-        "category": category,
-        "cost": round(cost, 2),
-        "suggested_price": suggested,
-        "margin_pct": margin_pct,
-        "images": images[:4],
-        "short_desc": (cj_product.get("description") or name)[:120],
-        "tags": tags,
-        "supplier": "cj_dropshipping",
-        "shipping_time": "7-14 days",
-        "weight_g": int(weight * 1000) if weight < 50 else int(weight),
-        "trending_score": max(60, 95 - index * 5),
-    }
+    Everything that depends only on the category is resolved here once,
+    not per product.
+    """
+    category = _CAT_INTERNED.get(category, category)
+    base_tags = tuple(CATEGORY_TAGS.get(category, ("trending",)))
+
+    def _transform(cj_product: dict, index: int) -> Optional[dict]:
+        """Transform CJ API product to DropOne format."""
+        pid = cj_product.get("pid", "")
+        name = cj_product.get("productNameEn", "")
+        image = cj_product.get("productImage", "")
+        cost = _parse_price(cj_product.get("sellPrice", 0))
+
+        if cost <= 0 or not name:
+            return None
+
+        suggested = min(round(cost * MARGIN_MULTIPLIER, 2), MAX_PRICE)
+        if suggested < cost * MIN_MARGIN_MULTIPLIER:
+            suggested = round(cost * MIN_MARGIN_MULTIPLIER, 2)
+        margin_pct = round((1 - cost / suggested) * 100) if suggested > 0 else 0
+
+        stable_id = _stable_id(pid)
+
+        images = [image] if image else []
+        seen = set(images)
+        for img in cj_product.get("productImageSet") or ():
+            if len(images) >= 4:
+                break
+            u = img.get("imageUrl", "") if isinstance(img, dict) else str(img)
+            if u and u not in seen:
+                seen.add(u)
+                images.append(u)
+
+        if len(name) > 60:
+            name = name[:57] + "..."
+
+        tags = list(base_tags)
+        name_l = name.lower()
+        tags.extend(kw for kw in _KW_LOWER if kw in name_l)
+        tags = list(dict.fromkeys(tags))[:5]
+
+        product = {
+            "id": stable_id,
+            "cj_pid": pid,
+            "cj_vid": "",
+            "name": name,
+            "category": category,
+            "cost": round(cost, 2),
+            "suggested_price": suggested,
+            "margin_pct": margin_pct,
+            "images": images,
+            "short_desc": (cj_product.get("description") or name)[:120],
+            "tags": tags,
+            "supplier": _SUPPLIER,
+            "shipping_time": _SHIPPING,
+            "weight_g": _coerce_weight_g(cj_product.get("productWeight")),
+            "trending_score": max(60, 95 - index * 5),
+        }
+        return product
+
+    return _transform
+
+
+def _search_blob(p: dict) -> str:
+    """Lowercased text matched by search_products (precomputed per product)."""
+    return f"{p['name']} {p.get('short_desc','')} {p['category']} {' '.join(p['tags'])}".lower()
 
 
 # ---------------------------------------------------------------------------
 # DEAD PRODUCT CLEANUP
 # ---------------------------------------------------------------------------
+def _finished_results(tasks: list) -> list:
+    """Results of the tasks that completed successfully (the rest are dropped)."""
+    return [t.result() for t in tasks if t.done() and not t.cancelled() and t.exception() is None]
+
+
 async def _check_product_alive(cj_client_mod, cj_pid: str) -> bool:
     """Check if a CJ product still exists and has variants."""
     try:
@@ -282,30 +502,33 @@ async def cleanup_dead_products(max_checks: int = 30) -> dict:
     dead_pids = set()
     alive_count = 0
 
-    # Check in batches of 5
-    for i in range(0, len(to_check), 5):
-        batch = to_check[i:i+5]
-        tasks = [_check_product_alive(cj_mod, p["cj_pid"]) for p in batch]
-        try:
-            results = await asyncio.wait_for(
-                asyncio.gather(*tasks, return_exceptions=True),
-                timeout=15.0,
-            )
-            for p, result in zip(batch, results):
-                if isinstance(result, Exception) or not result:
-                    dead_pids.add(p["cj_pid"])
-                    logger.info(f"Dead product: {p['name']} ({p['cj_pid']})")
-                else:
-                    alive_count += 1
-        except asyncio.TimeoutError:
-            logger.warning("Cleanup batch timed out, skipping rest")
-            break
+    # All checks concurrently (bounded), one deadline for the whole run
+    sem = asyncio.Semaphore(CLEANUP_CONCURRENCY)
+
+    async def check(cj_pid: str) -> bool:
+        async with sem:
+            return await _check_product_alive(cj_mod, cj_pid)
+
+    checks = [asyncio.create_task(check(p["cj_pid"])) for p in to_check]
+    try:
+        async with asyncio.timeout(CLEANUP_TIMEOUT):
+            await asyncio.gather(*checks, return_exceptions=True)
+    except TimeoutError:
+        logger.warning("Cleanup timed out, unfinished checks carry over to next sync")
+    for p, task in zip(to_check, checks):
+        if not task.done() or task.cancelled():
+            continue  # unfinished: neither alive nor dead, check again next sync
+        if task.exception() or not task.result():
+            dead_pids.add(p["cj_pid"])
+            logger.info(f"Dead product: {p['name']} ({p['cj_pid']})")
+        else:
+            alive_count += 1
 
     # Remove dead
     dead_names = [p["name"] for p in to_check if p["cj_pid"] in dead_pids]
     if dead_pids:
         before = len(products)
-        _cache["products"] = [p for p in products if p["cj_pid"] not in dead_pids]
+        _set_catalog([p for p in products if p["cj_pid"] not in dead_pids])
         logger.info(f"Cleaned {before - len(_cache['products'])} dead products")
 
     return {
@@ -319,19 +542,76 @@ async def cleanup_dead_products(max_checks: int = 30) -> dict:
 # ---------------------------------------------------------------------------
 # SYNC
 # ---------------------------------------------------------------------------
-async def _fetch_query(cj_client_mod, query: str, category: str) -> list:
-    """Fetch one CJ query, return transformed products."""
+async def _fetch_query(cj_client_mod, query: str, category: str) -> Optional[list]:
+    """Fetch one CJ query, return transformed products ([] if none match, None if the request failed)."""
     try:
-        results = await cj_client_mod.search_products(query, page=1, page_size=PRODUCTS_PER_QUERY)
-        products = []
-        for idx, cj_prod in enumerate(results):
-            p = _transform(cj_prod, category, query, idx)
-            if p:
-                products.append(p)
-        return products
+        results = await cj_client_mod.search_products(query, page=1, page_size=PRODUCTS_PER_QUERY, strict=True)
+        transform = _make_transformer(category)
+        return [p for p in (transform(cj_prod, idx) for idx, cj_prod in enumerate(results)) if p]
     except Exception as e:
         logger.warning(f"CJ query '{query}' failed: {e}")
-        return []
+        return None
+
+
+class _AdaptiveLimiter:
+    """AIMD concurrency cap for CJ queries.
+
+    Every `limit` completed queries, the cap is halved if more than 10% failed
+    and grows by one if none did. Only failed requests (429s and other errors,
+    raised by cj_client in strict mode) count; a query with no matches doesn't.
+    """
+
+    def __init__(self, initial: int, maximum: int):
+        self.limit = initial
+        self.maximum = maximum
+        self._active = 0
+        self._done = 0
+        self._failed = 0
+        self._cond = asyncio.Condition()
+
+    async def __aenter__(self):
+        async with self._cond:
+            await self._cond.wait_for(lambda: self._active < self.limit)
+            self._active += 1
+
+    async def __aexit__(self, *exc):
+        async with self._cond:
+            self._active -= 1
+            self._cond.notify_all()
+
+    def record(self, ok: bool):
+        self._done += 1
+        self._failed += not ok
+        if self._done < self.limit:
+            return
+        if self._failed > self._done * 0.1:
+            self.limit = max(1, self.limit // 2)
+        elif not self._failed:
+            self.limit = min(self.maximum, self.limit + 1)
+        self._done = self._failed = 0
+
+
+async def _fetch_limited(limiter: _AdaptiveLimiter, cj_client_mod, query: str, category: str) -> list:
+    async with limiter:
+        products = await _fetch_query(cj_client_mod, query, category)
+        limiter.record(products is not None)
+        return products or []
+
+
+# One CJ fan-out at a time; concurrent callers wait for it instead of starting their own.
+# Like the HTTP client, the lock belongs to one event loop and is rebuilt when it changes.
+_sync_lock: Optional[asyncio.Lock] = None
+_sync_lock_loop: Optional[asyncio.AbstractEventLoop] = None
+# (finished_at, use_rotation) of the last sync, whatever it returned
+_last_sync_run: tuple = (0.0, False)
+
+
+def _get_sync_lock() -> asyncio.Lock:
+    global _sync_lock, _sync_lock_loop
+    loop = asyncio.get_running_loop()
+    if _sync_lock is None or _sync_lock_loop is not loop:
+        _sync_lock, _sync_lock_loop = asyncio.Lock(), loop
+    return _sync_lock
 
 
 async def sync_catalog(use_rotation: bool = False):
@@ -340,10 +620,21 @@ async def sync_catalog(use_rotation: bool = False):
     Args:
         use_rotation: If True, uses the rotating query set (A/B).
     """
-    if _cache["syncing"]:
-        return
-    _cache["syncing"] = True
+    global _last_sync_run
+    requested = time.time()
+    async with _get_sync_lock():
+        # A sync of the same kind that finished while we waited is our result, even if
+        # CJ returned nothing: running it again would only repeat the wait
+        finished_at, rotation = _last_sync_run
+        if finished_at >= requested and rotation == use_rotation:
+            return
+        try:
+            await _sync_catalog(use_rotation)
+        finally:
+            _last_sync_run = (time.time(), use_rotation)
 
+
+async def _sync_catalog(use_rotation: bool):
     queries = _get_active_queries() if use_rotation else CATEGORY_QUERIES
     set_name = _get_active_set_name() if use_rotation else "A"
     logger.info(f"Starting CJ catalog sync (set {set_name})...")
@@ -356,38 +647,28 @@ async def sync_catalog(use_rotation: bool = False):
             for query in query_list:
                 tasks.append((query, category))
 
-        all_products = []
-        seen_pids = set()
-
-        for i in range(0, len(tasks), CONCURRENT_BATCH):
-            batch = tasks[i:i + CONCURRENT_BATCH]
-            coros = [_fetch_query(cj_mod, q, cat) for q, cat in batch]
-            try:
-                results = await asyncio.wait_for(
-                    asyncio.gather(*coros, return_exceptions=True),
-                    timeout=8.0,
-                )
-            except asyncio.TimeoutError:
-                logger.warning(f"Batch {i//CONCURRENT_BATCH + 1} timed out")
-                break
-
-            for result in results:
-                if isinstance(result, Exception):
-                    continue
-                for p in result:
-                    if p["cj_pid"] not in seen_pids:
-                        seen_pids.add(p["cj_pid"])
-                        all_products.append(p)
+        limiter = _AdaptiveLimiter(INITIAL_CONCURRENCY, CONCURRENT_BATCH)
+        fetches = [asyncio.create_task(_fetch_limited(limiter, cj_mod, q, cat)) for q, cat in tasks]
+        try:
+            async with asyncio.timeout(8.0):
+                await asyncio.gather(*fetches, return_exceptions=True)
+        except TimeoutError:
+            logger.warning(f"CJ fetch timed out (concurrency limit {limiter.limit}), keeping finished queries")
+        results = _finished_results(fetches)
+
+        # Dedupe on CJ pid, first query to return a product wins
+        by_pid = {}
+        for result in results:
+            for p in result:
+                by_pid.setdefault(p["cj_pid"], p)
+        all_products = list(by_pid.values())
 
         if all_products:
             all_products.sort(key=lambda p: (p["category"], -p["trending_score"]))
-            _cache["products"] = all_products
-            _cache["last_sync"] = time.time()
+            _set_catalog(all_products, time.time())
 
-            try:
-                _save_to_supabase(all_products)
-            except Exception:
-                pass
+            # Don't hold the sync (and the request) on the Supabase round-trip
+            _run_in_background(_save_to_supabase(_cache["products"]))
 
             logger.info(f"CJ sync OK: {len(all_products)} products, "
                         f"{len(set(p['category'] for p in all_products))} categories (set {set_name})")
@@ -396,8 +677,6 @@ async def sync_catalog(use_rotation: bool = False):
 
     except Exception as e:
         logger.error(f"Catalog sync error: {e}")
-    finally:
-        _cache["syncing"] = False
 
 
 async def weekly_sync() -> dict:
@@ -418,7 +697,9 @@ async def weekly_sync() -> dict:
     try:
         cleanup_stats = await cleanup_dead_products(max_checks=30)
         if cleanup_stats["removed"] > 0:
-            _save_to_supabase(_cache["products"])
+            # Let the post-sync save land first so it can't overwrite the cleaned catalog
+            await asyncio.gather(*_pending_background(), return_exceptions=True)
+            await _save_to_supabase(_cache["products"])
     except Exception as e:
         logger.error(f"Cleanup error: {e}")
 
@@ -438,7 +719,7 @@ async def weekly_sync() -> dict:
     }
 
     try:
-        _save_sync_log(stats)
+        await _save_sync_log(stats)
     except Exception:
         pass
 
@@ -447,28 +728,42 @@ async def weekly_sync() -> dict:
     return stats
 
 
+_refresh_task: Optional[asyncio.Task] = None
+
+
+def _refresh_in_background():
+    """Start a CJ sync without waiting for it, unless one is already pending."""
+    global _refresh_task
+    if _refresh_task is None or _refresh_task.done():
+        _refresh_task = _run_in_background(sync_catalog())
+
+
 async def ensure_catalog():
-    """Load catalog — from memory, then Supabase, then CJ API."""
+    """Load catalog — from memory, then Supabase, then CJ API.
+
+    A stale catalog is served as-is while a refresh runs in the background;
+    only an empty catalog waits on CJ.
+    """
     now = time.time()
 
-    # 1. In-memory cache still fresh?
-    if _cache["products"] and (now - _cache["last_sync"]) < CACHE_TTL:
+    # 1. In-memory cache (stale-while-revalidate)
+    if _cache["products"]:
+        if not _cache_fresh(now):
+            _refresh_in_background()
         return
 
     # 2. Try Supabase persistent cache
-    if not _cache["products"]:
-        products, synced_at = _load_from_supabase()
-        if products and (now - synced_at) < CACHE_TTL:
-            _cache["products"] = products
-            _cache["last_sync"] = synced_at
+    products, synced_at = await _load_from_supabase()
+    if products:
+        _set_catalog(products, synced_at)
+        if _cache_fresh(now):
             logger.info(f"Catalog loaded from Supabase: {len(products)} products")
-            return
-        elif products:
-            _cache["products"] = products
-            _cache["last_sync"] = synced_at
-            logger.info(f"Stale catalog from Supabase: {len(products)} products, will refresh")
+        else:
+            logger.info(f"Stale catalog from Supabase: {len(products)} products, refreshing in background")
+            _refresh_in_background()
+        return
 
-    # 3. Sync from CJ API
+    # 3. Nothing to serve yet: sync from CJ API
     await sync_catalog()
 
 
@@ -476,53 +771,46 @@ async def ensure_catalog():
 # PUBLIC API
 # ---------------------------------------------------------------------------
 def _get_products() -> list:
-    return _cache["products"]
+    """Current catalog (kept for modules that import it; PRODUCTS is the same list)."""
+    return PRODUCTS
 
 
 def get_product(product_id: str) -> Optional[dict]:
-    for p in _get_products():
-        if p["id"] == product_id:
-            return p
-    return None
+    return _by_id.get(product_id)
 
 
 def get_product_by_cj_pid(cj_pid: str) -> Optional[dict]:
-    for p in _get_products():
-        if p.get("cj_pid") == cj_pid:
-            return p
-    return None
+    return _by_cj_pid.get(cj_pid)
 
 
 def get_trending(limit: int = 20) -> list[dict]:
-    return sorted(_get_products(), key=lambda p: p["trending_score"], reverse=True)[:limit]
+    return _trending_sorted[:limit]
 
 
 def search_products(query: str) -> list[dict]:
+    """Substring search over name, description, category and tags."""
     q = query.lower()
-    return [
-        p for p in _get_products()
-        if q in f"{p['name']} {p.get('short_desc','')} {p['category']} {' '.join(p['tags'])}".lower()
-    ]
+    # A plain `in` over each precomputed blob: at catalog size (≤ MAX_CACHED_PRODUCTS)
+    # this C-level scan beats walking a token index's vocabulary
+    return [p for p, blob in zip(PRODUCTS, _search_blobs) if q in blob]
 
 
 def get_categories() -> list[str]:
-    return sorted(set(p["category"] for p in _get_products()))
+    return _categories_sorted
 
 
 def get_products_by_category(category: str) -> list[dict]:
-    return [p for p in _get_products() if p["category"] == category]
+    return _by_category.get(category, [])
 
 
 def get_catalog_stats() -> dict:
-    products = _get_products()
-    now = time.time()
+    last_sync = _cache["last_sync"]
+    age = time.time() - last_sync
     return {
-        "total_products": len(products),
-        "categories": len(set(p["category"] for p in products)),
-        "last_sync": _cache["last_sync"],
-        "cache_age_hours": round((now - _cache["last_sync"]) / 3600, 1) if _cache["last_sync"] else None,
-        "next_sync_hours": round((CACHE_TTL - (now - _cache["last_sync"])) / 3600, 1) if _cache["last_sync"] else 0,
-        "avg_margin": round(sum(p["margin_pct"] for p in products) / len(products), 1) if products else 0,
+        **_stats_base,
+        "last_sync": last_sync,
+        "source": "supabase_cache" if last_sync else "empty",
+        "cache_age_hours": round(age / 3600, 1) if last_sync else None,
+        "next_sync_hours": round((CACHE_TTL - age) / 3600, 1) if last_sync else 0,
         "query_set": _get_active_set_name(),
-        "source": "supabase_cache" if _cache["last_sync"] else "empty",
     }
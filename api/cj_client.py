@@ -5,18 +5,81 @@ API docs: https://developers.cjdropshipping.cn/en/api/api2/
 """
 
 import os
-import json
+import asyncio
 import logging
 import time
+from datetime import datetime
 from typing import Optional, Dict, List
 
 import httpx
 
+import jsonio
+
 logger = logging.getLogger("dropone.cj")
 
+
+class CJError(Exception):
+    """A CJ request failed (HTTP/transport error or result=false), as opposed to an empty result."""
+
+
 CJ_API_BASE = "https://developers.cjdropshipping.com/api2.0/v1"
 CJ_API_KEY = os.getenv("CJ_API_KEY", "")
 
+# Transient statuses retried with exponential backoff (GET only — POSTs may not be idempotent)
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+MAX_RETRIES = 3
+MAX_RETRY_DELAY = 8.0
+
+# Max concurrent page fetches in *_all helpers
+PAGE_CONCURRENCY = 8
+# Max concurrent createOrder calls in place_orders
+ORDER_CONCURRENCY = 16
+
+# Shared client: one connection pool (HTTP/2) for every CJ call instead of a handshake per call.
+# The pool and the asyncio locks below belong to one event loop; serverless runtimes may run
+# each invocation on a new loop, so they are rebuilt when the running loop changes.
+_client: Optional[httpx.AsyncClient] = None
+_client_loop: Optional[asyncio.AbstractEventLoop] = None
+
+
+def _bind_loop():
+    """Rebuild the loop-bound state (client, token lock, per-pid locks) for a new loop."""
+    global _client, _client_loop, _token_lock
+    loop = asyncio.get_running_loop()
+    if _client is not None and _client_loop is loop:
+        return
+    _client_loop = loop
+    _client = httpx.AsyncClient(
+        http2=True,
+        timeout=httpx.Timeout(30.0, connect=5.0, pool=5.0),
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=40, keepalive_expiry=30.0),
+    )
+    _token_lock = asyncio.Lock()
+    _product_locks.clear()
+
+
+def _get_client() -> httpx.AsyncClient:
+    _bind_loop()
+    return _client
+
+
+async def aclose():
+    """Close the shared CJ client (app shutdown)."""
+    global _client, _client_loop
+    # A client from another loop can't be closed from this one: just drop it
+    if _client is not None and _client_loop is asyncio.get_running_loop():
+        await _client.aclose()
+    _client = _client_loop = None
+
+
+_JSON_HEADERS = {"Content-Type": "application/json"}
+
+# Product detail cache: pid -> (expires_at, detail)
+PRODUCT_CACHE_TTL = 300
+PRODUCT_CACHE_MAX = 2048
+_product_cache: Dict[str, tuple] = {}
+_product_locks: Dict[str, list] = {}
+
 # Token cache (module-level)
 _token_cache = {
     "access_token": "",
@@ -29,30 +92,55 @@ _token_cache = {
 # ---------------------------------------------------------------------------
 # AUTH
 # ---------------------------------------------------------------------------
+# Serializes token fetches: a burst of callers after expiry triggers one auth request, not N
+_token_lock = asyncio.Lock()
+
+
+def _expiry(value, fallback: float) -> float:
+    """Epoch seconds from a CJ expiry date ("2024-08-18T09:16:33+08:00"), else fallback."""
+    try:
+        return datetime.fromisoformat(value).timestamp()
+    except (TypeError, ValueError):
+        return fallback
+
+
+def _store_token(d: dict, now: float):
+    _token_cache["access_token"] = d["accessToken"]
+    _token_cache["refresh_token"] = d["refreshToken"]
+    # Renew an hour before CJ's stated expiry (15 days / 180 days if it doesn't say)
+    _token_cache["expires_at"] = _expiry(d.get("accessTokenExpiryDate"), now + 15 * 86400) - 3600
+    _token_cache["refresh_expires_at"] = _expiry(d.get("refreshTokenExpiryDate"), now + 180 * 86400) - 86400
+
+
 async def _get_access_token() -> str:
     """Get valid access token, refreshing if needed."""
-    now = time.time()
-
-    if _token_cache["access_token"] and now < _token_cache["expires_at"]:
+    if _token_cache["access_token"] and time.time() < _token_cache["expires_at"]:
         return _token_cache["access_token"]
 
+    _bind_loop()
+    async with _token_lock:
+        # Another caller may have fetched it while we waited
+        now = time.time()
+        if _token_cache["access_token"] and now < _token_cache["expires_at"]:
+            return _token_cache["access_token"]
+        return await _fetch_access_token(now)
+
+
+async def _fetch_access_token(now: float) -> str:
     # Try refresh
     if _token_cache["refresh_token"] and now < _token_cache["refresh_expires_at"]:
         try:
-            async with httpx.AsyncClient(timeout=15) as client:
-                resp = await client.post(
-                    f"{CJ_API_BASE}/authentication/refreshAccessToken",
-                    json={"refreshToken": _token_cache["refresh_token"]},
-                )
-                data = resp.json()
-                if data.get("result"):
-                    d = data["data"]
-                    _token_cache["access_token"] = d["accessToken"]
-                    _token_cache["refresh_token"] = d["refreshToken"]
-                    _token_cache["expires_at"] = now + 14 * 86400 - 3600
-                    _token_cache["refresh_expires_at"] = now + 179 * 86400
-                    logger.info("CJ token refreshed")
-                    return _token_cache["access_token"]
+            resp = await _get_client().post(
+                f"{CJ_API_BASE}/authentication/refreshAccessToken",
+                headers=_JSON_HEADERS,
+                content=jsonio.dumps({"refreshToken": _token_cache["refresh_token"]}),
+                timeout=15,
+            )
+            data = jsonio.loads(resp.content)
+            if data.get("result"):
+                _store_token(data["data"], now)
+                logger.info("CJ token refreshed")
+                return _token_cache["access_token"]
         except Exception as e:
             logger.warning(f"CJ refresh failed: {e}")
 
@@ -62,28 +150,34 @@ async def _get_access_token() -> str:
         return ""
 
     try:
-        async with httpx.AsyncClient(timeout=15) as client:
-            resp = await client.post(
-                f"{CJ_API_BASE}/authentication/getAccessToken",
-                json={"apiKey": CJ_API_KEY},
-            )
-            data = resp.json()
-            if data.get("result"):
-                d = data["data"]
-                _token_cache["access_token"] = d["accessToken"]
-                _token_cache["refresh_token"] = d["refreshToken"]
-                _token_cache["expires_at"] = now + 14 * 86400 - 3600
-                _token_cache["refresh_expires_at"] = now + 179 * 86400
-                logger.info(f"CJ auth OK, openId={d.get('openId')}")
-                return _token_cache["access_token"]
-            else:
-                logger.error(f"CJ auth failed: {data.get('message')}")
-                return ""
+        resp = await _get_client().post(
+            f"{CJ_API_BASE}/authentication/getAccessToken",
+            headers=_JSON_HEADERS,
+            content=jsonio.dumps({"apiKey": CJ_API_KEY}),
+            timeout=15,
+        )
+        data = jsonio.loads(resp.content)
+        if data.get("result"):
+            d = data["data"]
+            _store_token(d, now)
+            logger.info(f"CJ auth OK, openId={d.get('openId')}")
+            return _token_cache["access_token"]
+        else:
+            logger.error(f"CJ auth failed: {data.get('message')}")
+            return ""
     except Exception as e:
         logger.error(f"CJ auth error: {e}")
         return ""
 
 
+def _retry_delay(resp: Optional[httpx.Response], attempt: int) -> float:
+    """Seconds to wait before retrying: Retry-After if given, else 1s, 2s, 4s… capped."""
+    try:
+        return min(float(resp.headers.get("Retry-After", "")), MAX_RETRY_DELAY)
+    except (AttributeError, ValueError):
+        return min(2 ** attempt, MAX_RETRY_DELAY)
+
+
 async def _cj(method: str, endpoint: str, payload: dict = None, params: dict = None) -> dict:
     """Make authenticated CJ API request."""
     token = await _get_access_token()
@@ -93,15 +187,29 @@ async def _cj(method: str, endpoint: str, payload: dict = None, params: dict = N
     url = f"{CJ_API_BASE}/{endpoint}"
     headers = {"CJ-Access-Token": token, "Content-Type": "application/json"}
 
+    client = _get_client()
     try:
-        async with httpx.AsyncClient(timeout=30) as client:
-            if method == "GET":
-                resp = await client.get(url, headers=headers, params=params)
-            elif method == "PATCH":
-                resp = await client.patch(url, headers=headers, json=payload)
-            else:
-                resp = await client.post(url, headers=headers, json=payload)
-            return resp.json()
+        if method == "GET":
+            for attempt in range(MAX_RETRIES + 1):
+                try:
+                    resp = await client.get(url, headers=headers, params=params)
+                except httpx.TransportError as e:
+                    # Connection reset, stale pooled connection, timeout…
+                    if attempt == MAX_RETRIES:
+                        raise
+                    resp, reason = None, repr(e)
+                else:
+                    if resp.status_code not in RETRY_STATUSES or attempt == MAX_RETRIES:
+                        break
+                    reason = f"HTTP {resp.status_code}"
+                delay = _retry_delay(resp, attempt)
+                logger.warning(f"CJ {endpoint}: {reason}, retrying in {delay:.0f}s")
+                await asyncio.sleep(delay)
+        elif method == "PATCH":
+            resp = await client.patch(url, headers=headers, content=jsonio.dumps(payload))
+        else:
+            resp = await client.post(url, headers=headers, content=jsonio.dumps(payload))
+        return jsonio.loads(resp.content)
     except Exception as e:
         logger.error(f"CJ {endpoint}: {e}")
         return {"result": False, "message": str(e)}
@@ -110,24 +218,78 @@ async def _cj(method: str, endpoint: str, payload: dict = None, params: dict = N
 # ---------------------------------------------------------------------------
 # PRODUCTS
 # ---------------------------------------------------------------------------
-async def search_products(keyword: str, page: int = 1, page_size: int = 20) -> List[Dict]:
-    """Search CJ products."""
+async def _search_page(keyword: str, page: int, page_size: int, strict: bool = False) -> Dict:
     data = await _cj("GET", "product/list", params={
         "productNameEn": keyword,
         "pageNum": page,
         "pageSize": page_size,
     })
     if data.get("result") and data.get("data"):
-        return data["data"].get("list", [])
-    return []
+        return data["data"]
+    if strict and not data.get("result"):
+        raise CJError(data.get("message") or "product/list failed")
+    return {}
+
+
+async def search_products(keyword: str, page: int = 1, page_size: int = 20,
+                          strict: bool = False) -> List[Dict]:
+    """Search CJ products. Errors give [] unless strict=True, which raises CJError
+    so callers can tell a failed request from a keyword with no matches."""
+    return (await _search_page(keyword, page, page_size, strict)).get("list", [])
+
+
+async def search_products_all(keyword: str, max_pages: int = 5, page_size: int = 20) -> List[Dict]:
+    """Search CJ products across pages: page 1 gives the total, the rest are fetched concurrently."""
+    first = await _search_page(keyword, 1, page_size)
+    products = list(first.get("list", []))
+    try:
+        total = int(first.get("total") or 0)
+    except (TypeError, ValueError):
+        total = 0
+    last = min(max_pages, -(-total // page_size))
+    if last < 2:
+        return products
+
+    sem = asyncio.Semaphore(PAGE_CONCURRENCY)
+
+    async def fetch(page: int) -> List[Dict]:
+        async with sem:
+            return (await _search_page(keyword, page, page_size)).get("list", [])
+
+    for page in await asyncio.gather(*(fetch(p) for p in range(2, last + 1))):
+        products.extend(page)
+    return products
 
 
 async def get_product(pid: str) -> Optional[Dict]:
-    """Get product detail by CJ pid."""
-    data = await _cj("GET", "product/query", params={"pid": pid})
-    if data.get("result") and data.get("data"):
-        return data["data"]
-    return None
+    """Get product detail by CJ pid (cached for PRODUCT_CACHE_TTL)."""
+    hit = _product_cache.get(pid)
+    if hit and hit[0] > time.time():
+        return hit[1]
+
+    # One fetch per pid at a time: concurrent callers wait and reuse its result.
+    # Entries are [lock, callers]; dropped once the last caller leaves, never while one waits.
+    entry = _product_locks.get(pid)
+    if entry is None:
+        entry = _product_locks[pid] = [asyncio.Lock(), 0]
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            hit = _product_cache.get(pid)
+            if hit and hit[0] > time.time():
+                return hit[1]
+            data = await _cj("GET", "product/query", params={"pid": pid})
+            detail = data["data"] if data.get("result") and data.get("data") else None
+            # Misses aren't cached: _cj reports transient errors the same way as unknown pids
+            if detail is not None:
+                if len(_product_cache) >= PRODUCT_CACHE_MAX:
+                    _product_cache.pop(next(iter(_product_cache)))  # oldest insert
+                _product_cache[pid] = (time.time() + PRODUCT_CACHE_TTL, detail)
+            return detail
+    finally:
+        entry[1] -= 1
+        if not entry[1]:
+            _product_locks.pop(pid, None)
 
 
 # ---------------------------------------------------------------------------
@@ -172,6 +334,24 @@ async def place_order(
     return {"success": False, "error": data.get("message", "CJ error")}
 
 
+async def place_orders(orders: List[Dict]) -> List[Dict]:
+    """Place several CJ orders concurrently (bounded). Each dict holds place_order's kwargs.
+
+    Results come back in input order; one failure doesn't affect the others.
+    """
+    sem = asyncio.Semaphore(ORDER_CONCURRENCY)
+
+    async def place(o: Dict) -> Dict:
+        async with sem:
+            try:
+                return await place_order(**o)
+            except Exception as e:
+                logger.error(f"CJ order {o.get('our_order_id')}: {e}")
+                return {"success": False, "error": str(e)}
+
+    return list(await asyncio.gather(*(place(o) for o in orders)))
+
+
 async def confirm_order(cj_order_id: str) -> Dict:
     """Confirm/pay a CJ order after creation."""
     data = await _cj("PATCH", "shopping/order/confirmOrder", payload={"orderId": cj_order_id})
@@ -204,21 +384,60 @@ async def get_tracking(cj_order_id: str) -> Optional[Dict]:
     return None
 
 
+async def _for_each_order(fn, cj_order_ids: List[str]) -> List[Optional[Dict]]:
+    """Run fn over many order ids concurrently (bounded); failures become None, input order kept."""
+    sem = asyncio.Semaphore(ORDER_CONCURRENCY)
+
+    async def one(oid: str) -> Optional[Dict]:
+        async with sem:
+            try:
+                return await fn(oid)
+            except Exception as e:
+                logger.error(f"CJ order {oid}: {e}")
+                return None
+
+    return list(await asyncio.gather(*(one(oid) for oid in cj_order_ids)))
+
+
+async def get_order_details_many(cj_order_ids: List[str]) -> List[Optional[Dict]]:
+    """get_order_detail for a list of orders (dashboards) — one round-trip of latency, not N."""
+    return await _for_each_order(get_order_detail, cj_order_ids)
+
+
+async def get_tracking_many(cj_order_ids: List[str]) -> List[Optional[Dict]]:
+    """get_tracking for a list of orders, results in input order."""
+    return await _for_each_order(get_tracking, cj_order_ids)
+
+
 # ---------------------------------------------------------------------------
 # SHIPPING ESTIMATE
 # ---------------------------------------------------------------------------
 async def shipping_estimate(vid: str, country_code: str, qty: int = 1) -> List[Dict]:
     """Get shipping options and costs."""
+    return await shipping_estimate_cart([{"vid": vid, "quantity": qty}], country_code)
+
+
+async def shipping_estimate_cart(products: List[Dict], country_code: str) -> List[Dict]:
+    """Shipping options for a whole cart ([{"vid", "quantity"}, ...]) in one CJ call."""
     data = await _cj("POST", "logistic/freightCalculate", payload={
         "startCountryCode": "",
         "endCountryCode": country_code,
-        "products": [{"vid": vid, "quantity": qty}],
+        "products": products,
     })
     if data.get("result") and data.get("data"):
         return data["data"]
     return []
 
 
+async def get_product_with_shipping(pid: str, vid: str, country_code: str, qty: int = 1) -> Dict:
+    """Product detail and shipping options, fetched concurrently."""
+    detail, shipping = await asyncio.gather(
+        get_product(pid),
+        shipping_estimate(vid, country_code, qty),
+    )
+    return {"product": detail, "shipping": shipping}
+
+
 # ---------------------------------------------------------------------------
 # HEALTH
 # ---------------------------------------------------------------------------
@@ -5,177 +5,199 @@ Every call wrapped in try/except. Never crashes the API.
 """
 
 import os
+import re
+import atexit
+import asyncio
 import hashlib
-import json
+import time
 import logging
+import threading
+from functools import lru_cache
 from datetime import datetime, timedelta
 from typing import Optional
 import httpx
 
+import jsonio
+
 logger = logging.getLogger("dropone.db")
 
 SUPABASE_URL = os.getenv("SUPABASE_URL", "").rstrip("/")
 SUPABASE_KEY = os.getenv("SUPABASE_SERVICE_KEY", "")
-
-def _headers():
-    return {
+# Keyed BLAKE2b for visitor IPs. Only as private as the key: with the public default,
+# anyone can hash the whole IPv4 space and reverse stored ip_hash values.
+IP_HASH_KEY = os.getenv("IP_HASH_KEY", "").encode()[:64]
+if not IP_HASH_KEY:
+    logger.warning("IP_HASH_KEY not set: visitor IP hashes use a public default key")
+    IP_HASH_KEY = b"dropone-ips"
+
+# One pooled (HTTP/2) client for every REST call instead of a TCP+TLS handshake per query.
+# Sync on purpose: callers are plain functions, some run in worker threads (Client is thread-safe).
+_client = httpx.Client(
+    http2=True,
+    base_url=f"{SUPABASE_URL}/rest/v1/",
+    headers={
         "apikey": SUPABASE_KEY,
         "Authorization": f"Bearer {SUPABASE_KEY}",
         "Content-Type": "application/json",
         "Prefer": "return=representation",
-    }
+    },
+    timeout=10.0,
+    limits=httpx.Limits(max_connections=64, max_keepalive_connections=32),
+)
+atexit.register(_client.close)
 
-def _rest(table: str) -> str:
-    return f"{SUPABASE_URL}/rest/v1/{table}"
+# Writes whose result nobody reads: PostgREST skips echoing the rows back
+_MINIMAL = {"Prefer": "return=minimal"}
 
 def _get(table: str, params: dict = None) -> list:
     try:
-        r = httpx.get(_rest(table), headers=_headers(), params=params or {}, timeout=10)
+        r = _client.get(table, params=params or {})
         r.raise_for_status()
-        return r.json()
+        return jsonio.loads(r.content)
     except Exception as e:
         logger.error(f"GET {table}: {e}")
         return []
 
-def _post(table: str, data: dict) -> list:
+def _post(table: str, data: dict | list, return_body: bool = False) -> list:
+    """Insert one row (dict) or many in a single request (list)."""
     try:
-        r = httpx.post(_rest(table), headers=_headers(), json=data, timeout=10)
+        r = _client.post(table, content=jsonio.dumps(data), headers=None if return_body else _MINIMAL)
         r.raise_for_status()
-        return r.json()
+        return jsonio.loads(r.content) if return_body else []
     except Exception as e:
         logger.error(f"POST {table}: {e}")
         return []
 
-def _patch(table: str, params: dict, data: dict) -> list:
+def _upsert(table: str, data: dict, on_conflict: str):
+    """INSERT ... ON CONFLICT DO UPDATE in one request (needs a unique index on on_conflict)."""
     try:
-        r = httpx.patch(_rest(table), headers=_headers(), params=params, json=data, timeout=10)
+        r = _client.post(table, params={"on_conflict": on_conflict}, content=jsonio.dumps(data),
+                         headers={"Prefer": "resolution=merge-duplicates,return=minimal"})
         r.raise_for_status()
-        return r.json()
+    except Exception as e:
+        logger.error(f"UPSERT {table}: {e}")
+
+def _patch(table: str, params: dict, data: dict, return_body: bool = False) -> list:
+    try:
+        r = _client.patch(table, params=params, content=jsonio.dumps(data), headers=None if return_body else _MINIMAL)
+        r.raise_for_status()
+        return jsonio.loads(r.content) if return_body else []
     except Exception as e:
         logger.error(f"PATCH {table}: {e}")
         return []
 
 def _delete(table: str, params: dict):
     try:
-        r = httpx.delete(_rest(table), headers=_headers(), params=params, timeout=10)
+        r = _client.delete(table, params=params, headers=_MINIMAL)
         r.raise_for_status()
     except Exception as e:
         logger.error(f"DELETE {table}: {e}")
 
+def _rpc(fn: str, args: dict):
+    """Call a Postgres function (migration-perf.sql). Returns its JSON result, None on void/error."""
+    try:
+        r = _client.post(f"rpc/{fn}", content=jsonio.dumps(args))
+        r.raise_for_status()
+        return jsonio.loads(r.content) if r.content else None
+    except Exception as e:
+        logger.error(f"RPC {fn}: {e}")
+        return None
+
+
+# ============================================================================
+# READ CACHE — store/user rows re-read within seconds (store pages, webhooks)
+# ============================================================================
+# Per-process and short-lived: local writes invalidate, other instances see changes after CACHE_TTL
+CACHE_TTL = 30.0
+CACHE_MAX = 10_000
+
+_store_cache: dict = {}
+_user_cache: dict = {}
+_cache_lock = threading.Lock()   # helpers also run in worker threads
+
+
+def _cache_get(cache: dict, key: str):
+    with _cache_lock:
+        hit = cache.get(key)
+    if hit and hit[0] > time.monotonic():
+        return hit[1]
+    return None
+
+
+def _cache_put(cache: dict, key: str, value):
+    with _cache_lock:
+        if len(cache) >= CACHE_MAX:
+            cache.pop(next(iter(cache)))   # oldest insert
+        cache[key] = (time.monotonic() + CACHE_TTL, value)
+
+
+def _cache_drop(cache: dict, key: str):
+    with _cache_lock:
+        cache.pop(key, None)
+
 
 # ============================================================================
 # USERS
 # ============================================================================
 def get_or_create_user(email: str) -> dict:
     try:
-        rows = _get("users", {"email": f"eq.{email}", "select": "*"})
-        if rows:
-            return rows[0]
-        user = {"email": email, "total_earnings": 0, "xp": 0, "level": 1}
-        res = _post("users", user)
-        return res[0] if res else user
+        # One round-trip; INSERT ... ON CONFLICT DO NOTHING, then the row
+        user = _rpc("get_or_create_user", {"p_email": email})
+        return user or {"email": email, "total_earnings": 0, "xp": 0, "level": 1}
     except Exception as e:
         logger.error(f"get_or_create_user({email}): {e}")
         return {"email": email, "total_earnings": 0, "xp": 0, "level": 1}
 
 
 def get_user(email: str) -> Optional[dict]:
+    user = _cache_get(_user_cache, email)
+    if user is not None:
+        return user
     try:
         rows = _get("users", {"email": f"eq.{email}", "select": "*"})
-        return rows[0] if rows else None
+        if not rows:
+            return None   # misses aren't cached: the user may be created right after
+        _cache_put(_user_cache, email, rows[0])
+        return rows[0]
     except Exception as e:
         logger.error(f"get_user: {e}")
         return None
 
 
-def update_user_earnings(email: str, amount: float):
-    """Add to both total_earnings AND withdrawable balance (for non-Connect payments)."""
-    try:
-        user = get_user(email)
-        if user:
-            new_earnings = round(float(user.get("total_earnings") or 0) + amount, 2)
-            new_balance = round(float(user.get("balance") or 0) + amount, 2)
-            _patch("users", {"email": f"eq.{email}"}, {
-                "total_earnings": new_earnings,
-                "balance": new_balance,
-            })
-    except Exception as e:
-        logger.error(f"update_user_earnings: {e}")
-
-
 def update_user_earnings_no_balance(email: str, amount: float):
     """Add to total_earnings only — balance NOT updated (seller already paid via Stripe Connect)."""
     try:
-        user = get_user(email)
-        if user:
-            new_earnings = round(float(user.get("total_earnings") or 0) + amount, 2)
-            _patch("users", {"email": f"eq.{email}"}, {
-                "total_earnings": new_earnings,
-            })
+        _rpc("increment_user_earnings", {"p_email": email, "p_amount": amount, "p_add_balance": False})
+        _cache_drop(_user_cache, email)
     except Exception as e:
         logger.error(f"update_user_earnings_no_balance: {e}")
 
 
-def update_user_xp(email: str, xp_gained: int, badges: list = None):
-    try:
-        user = get_user(email)
-        if not user:
-            return
-        new_xp = int(user.get("xp") or 0) + xp_gained
-        new_level = _calc_level(new_xp)
-        upd = {"xp": new_xp, "level": new_level}
-        if badges:
-            existing = user.get("badges") or []
-            if isinstance(existing, str):
-                existing = json.loads(existing)
-            upd["badges"] = list(set(existing + badges))
-        _patch("users", {"email": f"eq.{email}"}, upd)
-    except Exception as e:
-        logger.error(f"update_user_xp: {e}")
-
-
-def update_user_streak(email: str):
-    try:
-        user = get_user(email)
-        if not user:
-            return
-        today = datetime.utcnow().strftime("%Y-%m-%d")
-        yesterday = (datetime.utcnow() - timedelta(days=1)).strftime("%Y-%m-%d")
-        last = str(user.get("last_sale_date") or "")[:10]
-        if last == yesterday:
-            streak = int(user.get("streak_days") or 0) + 1
-        elif last == today:
-            streak = max(int(user.get("streak_days") or 1), 1)
-        else:
-            streak = 1
-        _patch("users", {"email": f"eq.{email}"}, {"streak_days": streak, "last_sale_date": today})
-    except Exception as e:
-        logger.error(f"update_user_streak: {e}")
-
-
-def _calc_level(xp: int) -> int:
-    level = 1
-    while level < 50 and xp >= int(100 * ((level + 1) ** 1.5)):
-        level += 1
-    return level
-
-
 # ============================================================================
 # STORES
 # ============================================================================
 def create_store(data: dict) -> dict:
     try:
-        res = _post("stores", data)
+        res = _post("stores", data, return_body=True)
         return res[0] if res else data
     except Exception as e:
         logger.error(f"create_store: {e}")
         return data
 
 
-def get_store(slug: str) -> Optional[dict]:
+def get_store(slug: str, fresh: bool = False) -> Optional[dict]:
+    """Store row, served from the short TTL cache unless fresh=True. Checkout, payment
+    webhooks and seller edits pass fresh=True: price and active flag must be current."""
+    if not fresh:
+        store = _cache_get(_store_cache, slug)
+        if store is not None:
+            return store
     try:
         rows = _get("stores", {"slug": f"eq.{slug}", "select": "*"})
-        return rows[0] if rows else None
+        if not rows:
+            return None
+        _cache_put(_store_cache, slug, rows[0])
+        return rows[0]
     except Exception as e:
         logger.error(f"get_store({slug}): {e}")
         return None
@@ -235,25 +257,18 @@ def soft_delete_store(slug: str):
 def update_store(slug: str, updates: dict):
     try:
         _patch("stores", {"slug": f"eq.{slug}"}, updates)
+        _cache_drop(_store_cache, slug)
     except Exception as e:
         logger.error(f"update_store: {e}")
 
 
-def increment_store_sales(slug: str, margin: float):
+def get_store_owner(slug: str) -> Optional[str]:
     try:
-        store = get_store(slug)
-        if store:
-            _patch("stores", {"slug": f"eq.{slug}"}, {
-                "total_sales": int(store.get("total_sales") or 0) + 1,
-                "total_revenue": round(float(store.get("total_revenue") or 0) + margin, 2),
-            })
+        rows = _get("stores", {"slug": f"eq.{slug}", "select": "owner_email", "limit": "1"})
+        return rows[0].get("owner_email") if rows else None
     except Exception as e:
-        logger.error(f"increment_store_sales: {e}")
-
-
-def get_store_owner(slug: str) -> Optional[str]:
-    store = get_store(slug)
-    return store.get("owner_email") if store else None
+        logger.error(f"get_store_owner({slug}): {e}")
+        return None
 
 
 # ============================================================================
@@ -261,7 +276,7 @@ def get_store_owner(slug: str) -> Optional[str]:
 # ============================================================================
 def create_order(data: dict) -> dict:
     try:
-        res = _post("orders", data)
+        res = _post("orders", data, return_body=True)
         return res[0] if res else data
     except Exception as e:
         logger.error(f"create_order: {e}")
@@ -287,14 +302,16 @@ def get_store_orders(slug: str) -> list[dict]:
 
 def get_all_orders_for_user(email: str) -> list[dict]:
     try:
-        # Include ALL stores (active + archived + deleted) to never lose order history
-        stores = _get("stores", {"owner_email": f"eq.{email}", "select": "slug"})
-        slugs = [s["slug"] for s in stores]
-        if not slugs:
-            return []
-        # Supabase REST: in filter
-        slug_filter = ",".join(slugs)
-        return _get("orders", {"store_slug": f"in.({slug_filter})", "select": "*", "order": "created_at.desc"})
+        # Include ALL stores (active + archived + deleted) to never lose order history.
+        # Inner-join the owning store server-side: one query instead of stores-then-orders.
+        rows = _get("orders", {
+            "select": "*,stores!inner(owner_email)",
+            "stores.owner_email": f"eq.{email}",
+            "order": "created_at.desc",
+        })
+        for o in rows:
+            o.pop("stores", None)
+        return rows
     except Exception as e:
         logger.error(f"get_all_orders_for_user: {e}")
         return []
@@ -334,108 +351,221 @@ def get_order_by_supplier_id(supplier_order_id: str) -> Optional[dict]:
 
 
 def get_order_stats(email: str) -> dict:
-    orders = get_all_orders_for_user(email)
-    statuses = {}
-    rev = margin = 0.0
-    for o in orders:
-        s = o.get("status", "pending")
-        statuses[s] = statuses.get(s, 0) + 1
-        rev += float(o.get("amount_paid") or 0)
-        margin += float(o.get("seller_margin") or 0)
-    return {"total_orders": len(orders), "by_status": statuses,
-            "total_revenue": round(rev, 2), "total_margin": round(margin, 2)}
+    try:
+        stats = _rpc("user_order_stats", {"p_email": email})
+        if stats:
+            return stats
+    except Exception as e:
+        logger.error(f"get_order_stats: {e}")
+    return {"total_orders": 0, "by_status": {}, "total_revenue": 0.0, "total_margin": 0.0}
 
 
 # ============================================================================
 # ANALYTICS
 # ============================================================================
+EVENT_QUEUE_MAX = 10_000
+EVENT_BATCH_SIZE = 200     # rows per bulk INSERT
+EVENT_FLUSH_INTERVAL = 1.0   # seconds a partial batch may wait
+
+# Fire-and-forget writes (analytics rows, view counters) as (table, row) pairs;
+# "rpc/<fn>" entries are function calls, sent one by one.
+_event_queue: Optional[asyncio.Queue] = None
+_event_flusher: Optional[asyncio.Task] = None
+_events_dropped = 0
+_STOP = None   # queued by flush_events: the flusher writes what it holds and exits
+
+
+def _enqueue(table: str, row: dict) -> bool:
+    """Queue a write for the background flusher. False when there is no running event loop
+    (called from a worker thread) — caller writes it directly. When the queue is full the
+    row is dropped and counted: a blocking write would stall the loop when it is busiest."""
+    global _events_dropped
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        return False
+    if _event_flusher is None or _event_flusher.done() or _event_flusher.get_loop() is not loop:
+        _start_flusher(loop)
+    try:
+        _event_queue.put_nowait((table, row))
+    except asyncio.QueueFull:
+        _events_dropped += 1
+        if _events_dropped % 1000 == 1:
+            logger.warning(f"event queue full: {_events_dropped} writes dropped so far")
+    return True
+
+
+def _start_flusher(loop: asyncio.AbstractEventLoop):
+    """(Re)build the queue and flusher on this loop. asyncio queues and tasks are bound to
+    one loop, and serverless runtimes may start a new loop per invocation: rows a previous
+    loop left behind move to the new queue instead of waiting on a loop that never runs."""
+    global _event_queue, _event_flusher
+    old = _event_queue
+    _event_queue = asyncio.Queue(maxsize=EVENT_QUEUE_MAX)
+    while old is not None and not old.empty():
+        item = old.get_nowait()
+        if item is not _STOP and not _event_queue.full():
+            _event_queue.put_nowait(item)
+    _event_flusher = loop.create_task(_flush_events(_event_queue))
+
+
+def _write_events(batch: list):
+    """One bulk INSERT per table (PostgREST accepts arrays), RPCs individually."""
+    by_table = {}
+    for table, row in batch:
+        by_table.setdefault(table, []).append(row)
+    for table, rows in by_table.items():
+        if table.startswith("rpc/"):
+            for args in rows:
+                _rpc(table[4:], args)
+        else:
+            _post(table, rows)
+
+
+async def _flush_events(queue: asyncio.Queue):
+    """Background writer: flushes every EVENT_BATCH_SIZE events or EVENT_FLUSH_INTERVAL,
+    until it dequeues _STOP. Cancelled with its loop (asyncio.run teardown), it writes
+    what it holds and what is queued synchronously rather than lose it."""
+    loop = asyncio.get_running_loop()
+    stop = False
+    batch = []
+    try:
+        while not stop:
+            item = await queue.get()
+            stop = item is _STOP
+            batch = [] if stop else [item]
+            deadline = loop.time() + EVENT_FLUSH_INTERVAL
+            while not stop and len(batch) < EVENT_BATCH_SIZE:
+                try:
+                    item = await asyncio.wait_for(queue.get(), deadline - loop.time())
+                except asyncio.TimeoutError:
+                    break
+                stop = item is _STOP
+                if not stop:
+                    batch.append(item)
+            if batch:
+                # _post/_rpc are blocking httpx: keep them off the event loop
+                await asyncio.to_thread(_write_events, batch)
+                batch = []
+    except asyncio.CancelledError:
+        while not queue.empty():
+            item = queue.get_nowait()
+            if item is not _STOP:
+                batch.append(item)
+        if batch:
+            _write_events(batch)
+        raise
+
+
+async def flush_events():
+    """Write everything still queued, including the flusher's in-flight batch (app shutdown)."""
+    global _event_flusher
+    if _event_queue is None:
+        return
+    flusher = _event_flusher
+    if flusher is not None and not flusher.done() and flusher.get_loop() is asyncio.get_running_loop():
+        await _event_queue.put(_STOP)
+        await flusher
+    _event_flusher = None
+    batch = []
+    while not _event_queue.empty():
+        item = _event_queue.get_nowait()
+        if item is not _STOP:
+            batch.append(item)
+    if batch:
+        await asyncio.to_thread(_write_events, batch)
+
+
 def track_view(store_slug: str, ip: str, user_agent: str, referrer: str):
     try:
-        _post("analytics_views", {
+        row = {
             "store_slug": store_slug,
-            "ip_hash": hashlib.sha256(ip.encode()).hexdigest()[:16] if ip else "",
+            "ip_hash": hashlib.blake2b(ip.encode(), digest_size=8, key=IP_HASH_KEY).hexdigest() if ip else "",
             "user_agent": (user_agent or "")[:500],
             "referrer": (referrer or "")[:500],
             "source": _detect_source(referrer),
             "device": _detect_device(user_agent),
-        })
+        }
+        if not _enqueue("analytics_views", row):
+            _post("analytics_views", row)
     except Exception as e:
         logger.error(f"track_view: {e}")
 
 
-def track_conversion(store_slug: str, order_id: str, amount: float):
-    try:
-        _post("analytics_conversions", {
-            "store_slug": store_slug, "order_id": order_id, "amount": amount,
-        })
-    except Exception as e:
-        logger.error(f"track_conversion: {e}")
-
-
 def get_analytics(store_slug: str, period: str = "7d") -> dict:
     empty = {"period": period, "total_views": 0, "total_conversions": 0,
              "total_revenue": 0, "conversion_rate": 0, "sources": {},
              "devices": {}, "daily_views": []}
     try:
-        cutoff = _period_dt(period).isoformat()
-        views = _get("analytics_views", {
-            "store_slug": f"eq.{store_slug}", "created_at": f"gte.{cutoff}",
-            "select": "source,device,created_at"
-        })
-        convs = _get("analytics_conversions", {
-            "store_slug": f"eq.{store_slug}", "created_at": f"gte.{cutoff}",
-            "select": "amount,created_at"
-        })
-        tv, tc = len(views), len(convs)
-        rev = sum(float(c.get("amount") or 0) for c in convs)
-        srcs, devs, daily = {}, {}, {}
-        for v in views:
-            s = v.get("source", "direct")
-            srcs[s] = srcs.get(s, 0) + 1
-            d = v.get("device", "unknown")
-            devs[d] = devs.get(d, 0) + 1
-            day = (v.get("created_at") or "")[:10]
-            if day:
-                daily[day] = daily.get(day, 0) + 1
+        cutoff = _period_cutoff(period)
+        # Grouped in Postgres: one small JSON object instead of every view row
+        a = _rpc("get_store_analytics", {"p_slug": store_slug, "p_cutoff": cutoff})
+        if not a:
+            return empty
+        tv, tc = int(a.get("total_views") or 0), int(a.get("total_conversions") or 0)
         return {"period": period, "total_views": tv, "total_conversions": tc,
-                "total_revenue": round(rev, 2),
+                "total_revenue": round(float(a.get("total_revenue") or 0), 2),
                 "conversion_rate": round(tc / max(tv, 1) * 100, 2),
-                "sources": srcs, "devices": devs,
-                "daily_views": [{"date": k, "views": v} for k, v in sorted(daily.items())]}
+                "sources": a.get("sources") or {}, "devices": a.get("devices") or {},
+                "daily_views": a.get("daily_views") or []}
     except Exception as e:
         logger.error(f"get_analytics: {e}")
         return empty
 
 
+_SOURCE_KEYWORDS = (("tiktok","tiktok"),("instagram","instagram"),("ig.me","instagram"),
+                    ("facebook","facebook"),("fb.me","facebook"),("twitter","twitter"),
+                    ("x.com","twitter"),("google","google"),("youtube","youtube"),
+                    ("whatsapp","whatsapp"),("wa.me","whatsapp"),("snapchat","snapchat"))
+# One C-level scan; the leftmost keyword wins (normally the referrer's own host)
+_SOURCE_RE = re.compile("|".join(re.escape(kw) for kw, _ in _SOURCE_KEYWORDS))
+_SOURCE_NAMES = dict(_SOURCE_KEYWORDS)
+_MOBILE_RE = re.compile("mobile|android|iphone")
+_TABLET_RE = re.compile("tablet|ipad")
+
+
+# Referrers and user agents repeat heavily across views: cache on the normalized
+# (truncated to the stored 500 chars, lowercased) string.
 def _detect_source(ref: str) -> str:
     if not ref:
         return "direct"
-    r = ref.lower()
-    for kw, name in [("tiktok","tiktok"),("instagram","instagram"),("ig.me","instagram"),
-                     ("facebook","facebook"),("fb.me","facebook"),("twitter","twitter"),
-                     ("x.com","twitter"),("google","google"),("youtube","youtube"),
-                     ("whatsapp","whatsapp"),("wa.me","whatsapp"),("snapchat","snapchat")]:
-        if kw in r:
-            return name
-    return "other"
+    return _source_of(ref[:500].lower())
+
+
+@lru_cache(maxsize=4096)
+def _source_of(r: str) -> str:
+    m = _SOURCE_RE.search(r)
+    return _SOURCE_NAMES[m.group()] if m else "other"
 
 
 def _detect_device(ua: str) -> str:
     if not ua:
         return "unknown"
-    u = ua.lower()
-    if any(k in u for k in ("mobile","android","iphone")):
+    return _device_of(ua[:500].lower())
+
+
+@lru_cache(maxsize=4096)
+def _device_of(u: str) -> str:
+    # Two scans, not one alternation: a mobile keyword wins even if a tablet one comes first
+    if _MOBILE_RE.search(u):
         return "mobile"
-    if any(k in u for k in ("tablet","ipad")):
+    if _TABLET_RE.search(u):
         return "tablet"
     return "desktop"
 
 
-def _period_dt(period: str) -> datetime:
-    now = datetime.utcnow()
-    if period == "24h":
-        return now - timedelta(hours=24)
-    return now - timedelta(days={"7d":7,"30d":30,"90d":90}.get(period, 7))
+_PERIODS = {"24h": timedelta(hours=24), "7d": timedelta(days=7),
+            "30d": timedelta(days=30), "90d": timedelta(days=90)}
+
+
+def _period_cutoff(period: str) -> str:
+    """ISO start of an analytics period (unknown periods mean 7d); memoised per second."""
+    return _cutoff_at(period, int(time.time()))
+
+
+@lru_cache(maxsize=128)
+def _cutoff_at(period: str, second: int) -> str:
+    return (datetime.utcfromtimestamp(second) - _PERIODS.get(period, _PERIODS["7d"])).isoformat()
 
 
 # ============================================================================
@@ -443,11 +573,7 @@ def _period_dt(period: str) -> datetime:
 # ============================================================================
 def save_push_subscription(email: str, subscription: dict):
     try:
-        existing = _get("push_subscriptions", {"email": f"eq.{email}", "select": "id"})
-        if existing:
-            _patch("push_subscriptions", {"email": f"eq.{email}"}, {"subscription": subscription})
-        else:
-            _post("push_subscriptions", {"email": email, "subscription": subscription})
+        _upsert("push_subscriptions", {"email": email, "subscription": subscription}, "email")
     except Exception as e:
         logger.error(f"save_push_subscription: {e}")
 
@@ -471,26 +597,29 @@ def remove_push_subscription(email: str):
 # ============================================================================
 # SELLER NETWORK
 # ============================================================================
-def record_network_sale(product_id: str, product_name: str, category: str,
-                        amount: float, seller_email: str, source: str = "direct"):
-    try:
-        _post("network_sales", {
-            "product_id": product_id, "product_name": product_name,
-            "category": category, "amount": amount,
-            "seller_email": seller_email, "source": source,
+def record_sale(store_slug: str, owner_email: str, order_id: str, product_id: str,
+                product_name: str, category: str, amount: float, margin: float, xp: int,
+                source: str = "direct"):
+    """All sale-time bookkeeping in one round-trip and one transaction: store sales,
+    seller earnings, conversion, network sale + product stats, XP and streak."""
+    try:
+        _rpc("record_sale", {
+            "p_slug": store_slug, "p_owner": owner_email, "p_order_id": order_id,
+            "p_product_id": product_id, "p_product_name": product_name, "p_category": category,
+            "p_amount": amount, "p_margin": margin, "p_xp": xp,
+            "p_today": datetime.utcnow().strftime("%Y-%m-%d"), "p_source": source,
         })
-        _upsert_product_stats(product_id, product_name, category, sales_delta=1, revenue_delta=amount)
+        _cache_drop(_store_cache, store_slug)
+        _cache_drop(_user_cache, owner_email)
     except Exception as e:
-        logger.error(f"record_network_sale: {e}")
+        logger.error(f"record_sale: {e}")
 
 
 def record_network_view(product_id: str):
     try:
-        s = _get("network_product_stats", {"product_id": f"eq.{product_id}", "select": "total_views"})
-        if s:
-            _patch("network_product_stats", {"product_id": f"eq.{product_id}"}, {
-                "total_views": int(s[0].get("total_views") or 0) + 1
-            })
+        args = {"p_product_id": product_id}
+        if not _enqueue("rpc/increment_product_views", args):
+            _rpc("increment_product_views", args)
     except Exception as e:
         logger.error(f"record_network_view: {e}")
 
@@ -502,56 +631,28 @@ def record_network_store_created(product_id: str, product_name: str = "", catego
 def _upsert_product_stats(pid: str, name: str, cat: str,
                            sales_delta: int = 0, revenue_delta: float = 0, stores_delta: int = 0):
     try:
-        ex = _get("network_product_stats", {"product_id": f"eq.{pid}", "select": "*"})
-        if ex:
-            r = ex[0]
-            _patch("network_product_stats", {"product_id": f"eq.{pid}"}, {
-                "total_sales": int(r.get("total_sales") or 0) + sales_delta,
-                "total_revenue": round(float(r.get("total_revenue") or 0) + revenue_delta, 2),
-                "stores_count": int(r.get("stores_count") or 0) + stores_delta,
-                "product_name": name or r.get("product_name", ""),
-            })
-        else:
-            _post("network_product_stats", {
-                "product_id": pid, "product_name": name, "category": cat,
-                "total_views": 0, "total_sales": sales_delta,
-                "total_revenue": revenue_delta, "stores_count": stores_delta,
-            })
+        # INSERT ... ON CONFLICT DO UPDATE server-side: one round-trip, no lost increments
+        _rpc("increment_product_stats", {
+            "p_product_id": pid, "p_name": name, "p_category": cat,
+            "p_sales": sales_delta, "p_revenue": revenue_delta, "p_stores": stores_delta,
+        })
     except Exception as e:
         logger.error(f"_upsert_product_stats: {e}")
 
 
 def get_network_trending(period: str = "7d", limit: int = 10) -> list[dict]:
     try:
-        cutoff = _period_dt(period).isoformat()
-        sales = _get("network_sales", {
-            "created_at": f"gte.{cutoff}",
-            "select": "product_id,product_name,category,amount"
+        # Pre-ranked hourly by the trending_snapshot materialized view (migration-perf.sql)
+        rows = _get("trending_snapshot", {
+            "period": f"eq.{period if period in _PERIODS else '7d'}",
+            "select": "product_id,product_name,category,sales_count,revenue,"
+                      "stores_selling,conversion_rate,trending_score",
+            "order": "trending_score.desc",
+            "limit": str(limit),
         })
-        if not sales:
-            return []
-        prods = {}
-        for s in sales:
-            pid = s["product_id"]
-            if pid not in prods:
-                prods[pid] = {"product_id": pid, "product_name": s.get("product_name") or pid,
-                              "category": s.get("category") or "", "sales_count": 0, "revenue": 0.0}
-            prods[pid]["sales_count"] += 1
-            prods[pid]["revenue"] += float(s.get("amount") or 0)
-
-        stats = _get("network_product_stats", {"select": "*"})
-        sm = {s["product_id"]: s for s in stats}
-        out = []
-        for pid, d in prods.items():
-            st = sm.get(pid, {})
-            views = int(st.get("total_views") or 0)
-            cr = round(d["sales_count"] / max(views, 1) * 100, 2)
-            d.update({"revenue": round(d["revenue"], 2), "stores_selling": int(st.get("stores_count") or 0),
-                       "conversion_rate": cr, "velocity_label": "🔥 En hausse",
-                       "trending_score": d["sales_count"] * 10 + cr * 5})
-            out.append(d)
-        out.sort(key=lambda x: x["trending_score"], reverse=True)
-        return out[:limit]
+        for d in rows:
+            d["velocity_label"] = "🔥 En hausse"
+        return rows
     except Exception as e:
         logger.error(f"get_network_trending: {e}")
         return []
@@ -559,29 +660,8 @@ def get_network_trending(period: str = "7d", limit: int = 10) -> list[dict]:
 
 def get_network_sources() -> list[dict]:
     try:
-        cutoff = _period_dt("30d").isoformat()
-        views = _get("analytics_views", {
-            "created_at": f"gte.{cutoff}", "select": "source,store_slug"
-        })
-        convs = _get("analytics_conversions", {
-            "created_at": f"gte.{cutoff}", "select": "store_slug"
-        })
-        conv_slugs = set(c["store_slug"] for c in convs)
-        src = {}
-        for v in views:
-            s = v.get("source", "direct")
-            if s not in src:
-                src[s] = {"total_traffic": 0, "conversions": 0}
-            src[s]["total_traffic"] += 1
-            if v.get("store_slug") in conv_slugs:
-                src[s]["conversions"] += 1
-        out = []
-        for name, d in src.items():
-            t = d["total_traffic"]
-            out.append({"source": name, "total_traffic": t, "conversions": d["conversions"],
-                         "conversion_rate": round(d["conversions"] / max(t, 1) * 100, 1)})
-        out.sort(key=lambda x: x["total_traffic"], reverse=True)
-        return out
+        # Grouped server-side by the network_sources_30d view (migration-perf.sql)
+        return _get("network_sources_30d", {"order": "total_traffic.desc"})
     except Exception as e:
         logger.error(f"get_network_sources: {e}")
         return []
@@ -589,21 +669,10 @@ def get_network_sources() -> list[dict]:
 
 def get_network_leaderboard(limit: int = 20) -> list[dict]:
     try:
-        rows = _get("users", {
-            "select": "email,xp,level,badges,streak_days,total_earnings",
-            "xp": "gt.0", "order": "xp.desc", "limit": str(limit)
-        })
-        board = []
-        for i, u in enumerate(rows):
-            email = u.get("email", "")
-            p = email.split("@")[0] if "@" in email else "user"
-            display = p[0].upper() + "***" + p[-1] if len(p) > 1 else "A***"
-            level = int(u.get("level") or 1)
-            board.append({"rank": i + 1, "display_name": display, "level": level,
-                           "level_name": _level_name(level), "xp": int(u.get("xp") or 0),
-                           "total_sales": 0, "badges": u.get("badges") or [],
-                           "streak_days": int(u.get("streak_days") or 0)})
-        return board
+        # Masked display names come from the network_leaderboard view (migration-perf.sql)
+        rows = _get("network_leaderboard", {"order": "xp.desc", "limit": str(limit)})
+        return [{**u, "rank": i, "level_name": _level_name(u["level"]), "total_sales": 0}
+                for i, u in enumerate(rows, 1)]
     except Exception as e:
         logger.error(f"get_network_leaderboard: {e}")
         return []
@@ -626,6 +695,7 @@ def get_seller_profile(email: str) -> dict:
             "next_level_xp": next_xp, "progress_pct": round(min(progress, 100), 1)}
 
 
+@lru_cache(maxsize=64)
 def _level_name(level: int) -> str:
     if level <= 2: return "🌱 Débutant"
     if level <= 5: return "📦 Vendeur"
@@ -642,13 +712,14 @@ def update_seller_payment(email: str, updates: dict):
     """Update seller payment info: stripe_account_id, paypal_email, payout_method, balance, etc."""
     try:
         _patch("users", {"email": f"eq.{email}"}, updates)
+        _cache_drop(_user_cache, email)
     except Exception as e:
         logger.error(f"update_seller_payment: {e}")
 
 
 def create_payout(data: dict) -> dict:
     try:
-        res = _post("payouts", data)
+        res = _post("payouts", data, return_body=True)
         return res[0] if res else data
     except Exception as e:
         logger.error(f"create_payout: {e}")
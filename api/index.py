@@ -11,12 +11,13 @@ import uuid
 import time
 import asyncio
 import hashlib
+from contextlib import asynccontextmanager
 from urllib.parse import quote as url_quote
 from datetime import datetime, timedelta
 from typing import Optional
 from fastapi import FastAPI, HTTPException, Request, Header
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse
+from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse, ORJSONResponse, Response
 from starlette.exceptions import HTTPException as StarletteHTTPException
 from pydantic import BaseModel, field_validator
 import stripe
@@ -30,6 +31,15 @@ from content_ai import generate_content, calculate_ad_budget
 from multi_store import get_collections, get_collection, suggest_upsells, generate_collection_with_ai
 from notifications import PushManager
 import cj_client
+import jsonio
+
+# uvloop: faster event loop for the asyncio-heavy catalog sync. Must be set
+# before the server creates its loop, hence at import time.
+try:
+    import uvloop
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+except ImportError:
+    pass
 
 # ---------------------------------------------------------------------------
 # Config
@@ -55,7 +65,20 @@ logger = logging.getLogger("dropone")
 # ---------------------------------------------------------------------------
 # App
 # ---------------------------------------------------------------------------
-app = FastAPI(title="DropOne API", version="5.0.0")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    app.state.health_body = _health_body()
+    yield
+    await catalog_mod.aclose()
+    await cj_client.aclose()
+    await db.flush_events()
+
+
+app = FastAPI(
+    title="DropOne API", version="5.0.0", lifespan=lifespan,
+    # orjson for every dict-returning endpoint (catalog pages, analytics) when installed
+    default_response_class=ORJSONResponse if jsonio.HAS_ORJSON else JSONResponse,
+)
 ALLOWED_ORIGINS = os.getenv("ALLOWED_ORIGINS", "*").split(",")
 app.add_middleware(
     CORSMiddleware,
@@ -133,9 +156,9 @@ async def serve_app():
 # ---------------------------------------------------------------------------
 # Health
 # ---------------------------------------------------------------------------
-@app.get("/health")
-async def health():
-    return {
+def _health_body() -> bytes:
+    """Encoded /health payload. Config is fixed for the process lifetime, so it's built once (lifespan)."""
+    health = {
         "status": "ok",
         "version": "5.0.0",
         "services": {
@@ -147,6 +170,16 @@ async def health():
             "push": bool(os.getenv("VAPID_PUBLIC_KEY")),
         },
     }
+    return jsonio.dumps(health)
+
+
+@app.get("/health")
+async def health(request: Request):
+    body = getattr(request.app.state, "health_body", None)
+    if body is None:   # runtime didn't send ASGI lifespan events
+        body = request.app.state.health_body = _health_body()
+    # Pre-encoded bytes: skips jsonable_encoder + dumps on every orchestrator poll
+    return Response(content=body, media_type="application/json")
 
 
 # ---------------------------------------------------------------------------
@@ -156,16 +189,15 @@ async def health():
 async def list_products(category: Optional[str] = None, sort: str = "trending",
                         q: Optional[str] = None, limit: int = 20, offset: int = 0):
     await catalog_mod.ensure_catalog()
-    products = catalog_mod._get_products()
     if q:
         prods = search_products(q)
     elif category:
         prods = get_products_by_category(category)
     else:
-        prods = get_trending(limit=200) if sort == "trending" else products
+        prods = get_trending(limit=200) if sort == "trending" else catalog_mod._get_products()
     total = len(prods)
     return {"products": prods[offset:offset + limit], "total": total,
-            "categories": sorted(set(p["category"] for p in products))}
+            "categories": get_categories()}
 
 
 @app.get("/api/products/{product_id}")
@@ -344,7 +376,7 @@ async def store_page(slug: str, request: Request):
 # FIX #7: Success page after payment
 @app.get("/s/{slug}/success", response_class=HTMLResponse)
 async def store_success(slug: str, request: Request):
-    store = db.get_store(slug)
+    store = db.get_store(slug, fresh=True)
     if not store:
         raise HTTPException(404, "Store not found")
 
@@ -367,7 +399,7 @@ async def store_success(slug: str, request: Request):
 # ---------------------------------------------------------------------------
 @app.post("/api/checkout/create")
 async def create_checkout(req: CheckoutRequest):
-    store = db.get_store(req.store_slug)
+    store = db.get_store(req.store_slug, fresh=True)
     if not store:
         raise HTTPException(404, "Store not found")
     if not store.get("active", True):
@@ -553,7 +585,7 @@ async def capture_paypal_endpoint(paypal_order_id: str):
     parts = custom_str.split("|")
     slug = parts[0] if parts else unit.get("reference_id", "")
 
-    store = db.get_store(slug)
+    store = db.get_store(slug, fresh=True)
     if not store:
         raise HTTPException(404, "Store not found for this PayPal order")
 
@@ -581,7 +613,7 @@ async def stripe_webhook(request: Request):
         session = event["data"]["object"]
         meta = session.get("metadata", {})
         slug = meta.get("store_slug", "")
-        store = db.get_store(slug)
+        store = db.get_store(slug, fresh=True)
         if store:
             shipping = session.get("shipping_details", {})
             await _process_completed_order(
@@ -622,22 +654,18 @@ async def _process_completed_order(store, customer_email, customer_name,
         "paypal_order_id": payment_id if payment_provider == "paypal" else None,
     })
 
-    db.increment_store_sales(store["slug"], seller_margin)
-    db.update_user_earnings(store["owner_email"], seller_margin)
-    db.track_conversion(store["slug"], order_id, amount_paid)
-
-    db.record_network_sale(
+    db.record_sale(
+        store_slug=store["slug"],
+        owner_email=store["owner_email"],
+        order_id=order_id,
         product_id=store.get("product_id", ""),
         product_name=product.get("name", ""),
         category=product.get("category", ""),
         amount=amount_paid,
-        seller_email=store["owner_email"],
+        margin=seller_margin,
+        xp=10 + int(amount_paid / 10),
     )
 
-    xp = 10 + int(amount_paid / 10)
-    db.update_user_xp(store["owner_email"], xp)
-    db.update_user_streak(store["owner_email"])
-
     try:
         await push_mgr.notify_sale(
             seller_email=store["owner_email"],
@@ -704,7 +732,8 @@ async def _process_completed_order(store, customer_email, customer_name,
 # ---------------------------------------------------------------------------
 @app.post("/api/webhook/cj")
 async def cj_webhook(request: Request):
-    payload = await request.json()
+    body = await request.body()
+    payload = jsonio.loads(body)
     event_type = payload.get("type", "")
     cj_order_id = payload.get("orderId", "")
     tracking = payload.get("trackingNumber", "")
@@ -733,7 +762,7 @@ async def cj_webhook(request: Request):
                     "shipped_at": datetime.utcnow().isoformat(),
                 })
                 # Notify seller
-                store = db.get_store(order["store_slug"])
+                store = db.get_store(order["store_slug"], fresh=True)
                 if store:
                     try:
                         await push_mgr.notify_shipped(
@@ -957,7 +986,7 @@ async def update_price(slug: str, request: Request):
     new_price = float(body.get("new_price", 0))
     email = body.get("email", "")
 
-    store = db.get_store(slug)
+    store = db.get_store(slug, fresh=True)
     if not store:
         raise HTTPException(404, "Store not found")
     if email and store.get("owner_email") != email:
@@ -969,7 +998,7 @@ async def update_price(slug: str, request: Request):
     margin = round(new_price - float(store["supplier_cost"]) - comm, 2)
     db.update_store(slug, {"seller_price": new_price, "commission": comm,
                             "margin": margin, "margin_pct": round((margin / new_price) * 100, 1)})
-    return db.get_store(slug)
+    return db.get_store(slug, fresh=True)
 
 
 @app.put("/api/stores/{slug}/toggle")
@@ -977,7 +1006,7 @@ async def toggle_store(slug: str, request: Request):
     body = await request.json()
     email = body.get("email", "")
 
-    store = db.get_store(slug)
+    store = db.get_store(slug, fresh=True)
     if not store:
         raise HTTPException(404, "Store not found")
     if email and store.get("owner_email") != email:
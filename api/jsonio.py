@@ -0,0 +1,26 @@
+"""
+DropOne — JSON encode/decode
+orjson when installed (see requirements.txt), stdlib json otherwise.
+"""
+
+import json
+
+try:
+    import orjson
+    HAS_ORJSON = True
+except ImportError:
+    HAS_ORJSON = False
+
+
+def loads(data):
+    """Decode JSON from bytes or str (e.g. an httpx response's .content)."""
+    if HAS_ORJSON:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def dumps(obj) -> bytes:
+    """Encode to UTF-8 JSON bytes, ready for httpx content= or a raw Response body."""
+    if HAS_ORJSON:
+        return orjson.dumps(obj)
+    return json.dumps(obj).encode()
@@ -0,0 +1,253 @@
+-- ============================================================================
+-- DropOne: Performance Migration
+-- Run this in Supabase SQL Editor (safe to re-run)
+-- ============================================================================
+
+-- ===== KV_CACHE: store values as JSONB =====
+-- The catalog is sent as a JSON object instead of a JSON string inside JSON,
+-- so Supabase and the API each parse it once. Existing TEXT rows are converted
+-- in place; catalog.py still reads TEXT rows if this hasn't been run yet.
+DO $$ BEGIN
+  IF (SELECT data_type FROM information_schema.columns
+      WHERE table_name = 'kv_cache' AND column_name = 'value') = 'text' THEN
+    ALTER TABLE kv_cache ALTER COLUMN value DROP DEFAULT;
+    ALTER TABLE kv_cache ALTER COLUMN value TYPE JSONB USING value::jsonb;
+    ALTER TABLE kv_cache ALTER COLUMN value SET DEFAULT '{}'::jsonb;
+  END IF;
+END $$;
+
+-- ===== KV_CACHE: content hash for skip-if-unchanged saves =====
+-- catalog.py compares this before uploading; an identical catalog only gets
+-- its updated_at bumped instead of a full rewrite.
+ALTER TABLE kv_cache ADD COLUMN IF NOT EXISTS content_hash TEXT;
+
+-- ===== ATOMIC COUNTERS (api/database.py calls these via /rest/v1/rpc/*) =====
+-- One round-trip per update, and no lost updates when two sales land at once.
+-- Run this before deploying the matching API code.
+CREATE OR REPLACE FUNCTION get_or_create_user(p_email TEXT)
+RETURNS users AS $$
+    INSERT INTO users (email, total_earnings, xp, level)
+    VALUES (p_email, 0, 0, 1)
+    ON CONFLICT (email) DO NOTHING;
+    SELECT * FROM users WHERE email = p_email;
+$$ LANGUAGE sql;
+
+CREATE OR REPLACE FUNCTION increment_user_earnings(p_email TEXT, p_amount NUMERIC, p_add_balance BOOLEAN DEFAULT TRUE)
+RETURNS VOID AS $$
+    UPDATE users
+    SET total_earnings = ROUND(COALESCE(total_earnings, 0) + p_amount, 2),
+        balance = CASE WHEN p_add_balance THEN ROUND(COALESCE(balance, 0) + p_amount, 2) ELSE balance END
+    WHERE email = p_email;
+$$ LANGUAGE sql;
+
+CREATE OR REPLACE FUNCTION increment_store_sales(p_slug TEXT, p_margin NUMERIC)
+RETURNS VOID AS $$
+    UPDATE stores
+    SET total_sales = COALESCE(total_sales, 0) + 1,
+        total_revenue = ROUND(COALESCE(total_revenue, 0) + p_margin, 2)
+    WHERE slug = p_slug;
+$$ LANGUAGE sql;
+
+CREATE OR REPLACE FUNCTION increment_product_stats(p_product_id TEXT, p_name TEXT, p_category TEXT,
+                                                   p_sales INTEGER DEFAULT 0, p_revenue NUMERIC DEFAULT 0,
+                                                   p_stores INTEGER DEFAULT 0)
+RETURNS VOID AS $$
+    INSERT INTO network_product_stats (product_id, product_name, category, total_views,
+                                       total_sales, total_revenue, stores_count)
+    VALUES (p_product_id, p_name, p_category, 0, p_sales, p_revenue, p_stores)
+    ON CONFLICT (product_id) DO UPDATE
+    SET total_sales = COALESCE(network_product_stats.total_sales, 0) + EXCLUDED.total_sales,
+        total_revenue = ROUND(COALESCE(network_product_stats.total_revenue, 0) + EXCLUDED.total_revenue, 2),
+        stores_count = COALESCE(network_product_stats.stores_count, 0) + EXCLUDED.stores_count,
+        product_name = COALESCE(NULLIF(EXCLUDED.product_name, ''), network_product_stats.product_name);
+$$ LANGUAGE sql;
+
+CREATE OR REPLACE FUNCTION increment_product_views(p_product_id TEXT)
+RETURNS VOID AS $$
+    UPDATE network_product_stats
+    SET total_views = COALESCE(total_views, 0) + 1
+    WHERE product_id = p_product_id;
+$$ LANGUAGE sql;
+
+-- ===== PUSH SUBSCRIPTIONS: one row per email (database.save_push_subscription upserts) =====
+DELETE FROM push_subscriptions p
+USING push_subscriptions newer
+WHERE p.email = newer.email
+  AND (p.created_at, p.id) < (newer.created_at, newer.id);
+CREATE UNIQUE INDEX IF NOT EXISTS idx_push_email_unique ON push_subscriptions(email);
+
+-- ===== GAMIFICATION: XP/level and streak updated in place =====
+-- Same curve as the old Python _calc_level: next level at floor(100 * (level+1)^1.5) XP, max 50.
+-- Closed-form inverse (xp/100)^(2/3), then one exact threshold check to absorb rounding.
+CREATE OR REPLACE FUNCTION calc_level(p_xp INTEGER)
+RETURNS INTEGER AS $$
+    SELECT CASE
+        WHEN est < 50 AND p_xp >= FLOOR(100 * POWER(est + 1, 1.5)) THEN est + 1
+        WHEN est > 1 AND p_xp < FLOOR(100 * POWER(est, 1.5)) THEN est - 1
+        ELSE est
+    END
+    FROM (SELECT LEAST(50, GREATEST(1, FLOOR(POWER(GREATEST(p_xp, 0) / 100.0, 2.0 / 3))::INTEGER)) AS est) e;
+$$ LANGUAGE sql IMMUTABLE;
+
+CREATE OR REPLACE FUNCTION add_xp_and_level(p_email TEXT, p_delta INTEGER, p_badges TEXT[] DEFAULT '{}')
+RETURNS VOID AS $$
+    UPDATE users
+    SET xp = COALESCE(xp, 0) + p_delta,
+        level = calc_level(COALESCE(xp, 0) + p_delta),
+        badges = CASE WHEN cardinality(p_badges) = 0 THEN badges ELSE (
+            SELECT COALESCE(jsonb_agg(DISTINCT b), '[]'::jsonb)
+            FROM jsonb_array_elements_text(
+                CASE WHEN jsonb_typeof(badges) = 'array' THEN badges ELSE '[]'::jsonb END
+                || to_jsonb(p_badges)) AS b
+        ) END
+    WHERE email = p_email;
+$$ LANGUAGE sql;
+
+CREATE OR REPLACE FUNCTION upsert_streak(p_email TEXT, p_today DATE)
+RETURNS VOID AS $$
+    UPDATE users
+    SET streak_days = CASE
+            WHEN last_sale_date = p_today - 1 THEN COALESCE(streak_days, 0) + 1
+            WHEN last_sale_date = p_today THEN GREATEST(COALESCE(NULLIF(streak_days, 0), 1), 1)
+            ELSE 1
+        END,
+        last_sale_date = p_today
+    WHERE email = p_email;
+$$ LANGUAGE sql;
+
+-- ===== NETWORK TRENDING: hourly snapshot (database.get_network_trending) =====
+-- One row per (period, product); Python just reads the top N for a period.
+CREATE MATERIALIZED VIEW IF NOT EXISTS trending_snapshot AS
+WITH periods(period, since) AS (
+    VALUES ('24h', NOW() - INTERVAL '24 hours'), ('7d', NOW() - INTERVAL '7 days'),
+           ('30d', NOW() - INTERVAL '30 days'), ('90d', NOW() - INTERVAL '90 days')
+), sales AS (
+    SELECT p.period, ns.product_id,
+           COALESCE(MAX(NULLIF(ns.product_name, '')), ns.product_id) AS product_name,
+           COALESCE(MAX(ns.category), '') AS category,
+           COUNT(*) AS sales_count,
+           ROUND(COALESCE(SUM(ns.amount), 0), 2) AS revenue
+    FROM periods p
+    JOIN network_sales ns ON ns.created_at >= p.since
+    GROUP BY p.period, ns.product_id
+)
+SELECT s.period, s.product_id, s.product_name, s.category, s.sales_count, s.revenue,
+       COALESCE(nps.stores_count, 0) AS stores_selling,
+       cr.conversion_rate,
+       s.sales_count * 10 + cr.conversion_rate * 5 AS trending_score
+FROM sales s
+LEFT JOIN network_product_stats nps ON nps.product_id = s.product_id
+CROSS JOIN LATERAL (
+    SELECT ROUND(s.sales_count * 100.0 / GREATEST(COALESCE(nps.total_views, 0), 1), 2) AS conversion_rate
+) cr;
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_trending_snapshot_pk ON trending_snapshot(period, product_id);
+CREATE INDEX IF NOT EXISTS idx_trending_snapshot_score ON trending_snapshot(period, trending_score DESC);
+
+-- Refresh hourly (CONCURRENTLY keeps it readable during the refresh; needs the unique index above)
+CREATE EXTENSION IF NOT EXISTS pg_cron;
+SELECT cron.schedule('refresh-trending-snapshot', '0 * * * *',
+                     'REFRESH MATERIALIZED VIEW CONCURRENTLY trending_snapshot');
+
+-- ===== STORE ANALYTICS: aggregate in SQL (database.get_analytics) =====
+CREATE INDEX IF NOT EXISTS idx_views_store_date ON analytics_views(store_slug, created_at DESC);
+CREATE INDEX IF NOT EXISTS idx_conv_store_date ON analytics_conversions(store_slug, created_at DESC);
+
+CREATE OR REPLACE FUNCTION get_store_analytics(p_slug TEXT, p_cutoff TIMESTAMPTZ)
+RETURNS JSONB AS $$
+    WITH v AS (
+        SELECT COALESCE(source, 'direct') AS source,
+               COALESCE(device, 'unknown') AS device,
+               to_char(created_at AT TIME ZONE 'UTC', 'YYYY-MM-DD') AS day
+        FROM analytics_views
+        WHERE store_slug = p_slug AND created_at >= p_cutoff
+    ), c AS (
+        SELECT COUNT(*) AS n, COALESCE(SUM(amount), 0) AS revenue
+        FROM analytics_conversions
+        WHERE store_slug = p_slug AND created_at >= p_cutoff
+    )
+    SELECT jsonb_build_object(
+        'total_views', (SELECT COUNT(*) FROM v),
+        'total_conversions', (SELECT n FROM c),
+        'total_revenue', (SELECT revenue FROM c),
+        'sources', COALESCE((SELECT jsonb_object_agg(source, n)
+                             FROM (SELECT source, COUNT(*) AS n FROM v GROUP BY source) s), '{}'::jsonb),
+        'devices', COALESCE((SELECT jsonb_object_agg(device, n)
+                             FROM (SELECT device, COUNT(*) AS n FROM v GROUP BY device) d), '{}'::jsonb),
+        'daily_views', COALESCE((SELECT jsonb_agg(jsonb_build_object('date', day, 'views', n) ORDER BY day)
+                                 FROM (SELECT day, COUNT(*) AS n FROM v GROUP BY day) g), '[]'::jsonb)
+    );
+$$ LANGUAGE sql STABLE;
+
+-- ===== NETWORK SOURCES: grouped in SQL (database.get_network_sources) =====
+CREATE OR REPLACE VIEW network_sources_30d AS
+WITH converting AS (
+    SELECT DISTINCT store_slug
+    FROM analytics_conversions
+    WHERE created_at >= NOW() - INTERVAL '30 days'
+)
+SELECT COALESCE(v.source, 'direct') AS source,
+       COUNT(*) AS total_traffic,
+       COUNT(c.store_slug) AS conversions,
+       ROUND(COUNT(c.store_slug) * 100.0 / GREATEST(COUNT(*), 1), 1) AS conversion_rate
+FROM analytics_views v
+LEFT JOIN converting c ON c.store_slug = v.store_slug
+WHERE v.created_at >= NOW() - INTERVAL '30 days'
+GROUP BY COALESCE(v.source, 'direct');
+
+-- ===== ORDER STATS: per-seller totals in one call (database.get_order_stats) =====
+CREATE OR REPLACE FUNCTION user_order_stats(p_email TEXT)
+RETURNS JSONB AS $$
+    WITH g AS (
+        SELECT COALESCE(o.status, 'pending') AS status, COUNT(*) AS n,
+               COALESCE(SUM(o.amount_paid), 0) AS revenue,
+               COALESCE(SUM(o.seller_margin), 0) AS margin
+        FROM orders o
+        JOIN stores s ON s.slug = o.store_slug
+        WHERE s.owner_email = p_email
+        GROUP BY 1
+    )
+    SELECT jsonb_build_object(
+        'total_orders', COALESCE(SUM(n), 0),
+        'by_status', COALESCE(jsonb_object_agg(status, n), '{}'::jsonb),
+        'total_revenue', ROUND(COALESCE(SUM(revenue), 0), 2),
+        'total_margin', ROUND(COALESCE(SUM(margin), 0), 2)
+    )
+    FROM g;
+$$ LANGUAGE sql STABLE;
+
+-- ===== SALE: every sale-time write in one transaction (database.record_sale) =====
+-- Depends on the counter/gamification functions above.
+CREATE OR REPLACE FUNCTION record_sale(p_slug TEXT, p_owner TEXT, p_order_id TEXT,
+                                       p_product_id TEXT, p_product_name TEXT, p_category TEXT,
+                                       p_amount NUMERIC, p_margin NUMERIC, p_xp INTEGER,
+                                       p_today DATE, p_source TEXT DEFAULT 'direct')
+RETURNS VOID AS $$
+BEGIN
+    PERFORM increment_store_sales(p_slug, p_margin);
+    PERFORM increment_user_earnings(p_owner, p_margin, TRUE);
+    INSERT INTO analytics_conversions (store_slug, order_id, amount)
+    VALUES (p_slug, p_order_id, p_amount);
+    INSERT INTO network_sales (product_id, product_name, category, amount, seller_email, source)
+    VALUES (p_product_id, p_product_name, p_category, p_amount, p_owner, p_source);
+    PERFORM increment_product_stats(p_product_id, p_product_name, p_category, 1, p_amount, 0);
+    PERFORM add_xp_and_level(p_owner, p_xp);
+    PERFORM upsert_streak(p_owner, p_today);
+END;
+$$ LANGUAGE plpgsql;
+
+-- ===== LEADERBOARD: masked names computed in SQL (database.get_network_leaderboard) =====
+CREATE INDEX IF NOT EXISTS idx_users_xp_leaderboard ON users(xp DESC) WHERE xp > 0;
+
+CREATE OR REPLACE VIEW network_leaderboard AS
+SELECT CASE WHEN length(p) > 1 THEN upper(left(p, 1)) || '***' || right(p, 1) ELSE 'A***' END AS display_name,
+       COALESCE(level, 1) AS level,
+       xp,
+       COALESCE(badges, '[]'::jsonb) AS badges,
+       COALESCE(streak_days, 0) AS streak_days
+FROM (
+    SELECT level, xp, badges, streak_days,
+           CASE WHEN position('@' IN email) > 0 THEN split_part(email, '@', 1) ELSE 'user' END AS p
+    FROM users
+    WHERE xp > 0
+) u;